@@ -0,0 +1,61 @@
+"""Benchmark: retrieval memory query latency at 100k stored turns
+
+Fills a VectorIndex in a temporary directory with random unit vectors
+(768 dimensions, like nomic-embed-text) spread over 50 channels, then
+times guild-wide and single-channel top-k searches. Embedding time isn't
+included since that happens on Ollama. Needs numpy. Run from the
+repository root:
+    python benchmarks/bench_retrieval.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOGS_CHANNEL_ID', '0')
+
+import numpy as np  # noqa: E402
+
+from bot import VectorIndex  # noqa: E402
+
+TURNS = 100_000
+DIM = 768
+CHANNELS = 50
+BATCH = 32
+QUERIES = 200
+TOP_K = 4
+
+def unit_rows(rng: np.random.Generator, count: int) -> np.ndarray:
+    rows = rng.standard_normal((count, DIM)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+def percentile(samples, p):
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def main():
+    rng = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as directory:
+        index = VectorIndex(os.path.join(directory, 'guild'), 'bench')
+        started = time.perf_counter()
+        for start in range(0, TURNS, BATCH):
+            count = min(BATCH, TURNS - start)
+            index.append(unit_rows(rng, count), rng.integers(0, CHANNELS, count))
+        index.flush()
+        fill = time.perf_counter() - started
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f"Indexed {index.count} turns in {fill:.2f}s ({size / 1024 ** 2:.0f} MB on disk)")
+
+        queries = unit_rows(rng, QUERIES)
+        print(f"{'search':>14}  {'p50 (ms)':>9}  {'p95 (ms)':>9}  {'p99 (ms)':>9}")
+        for label, channel_id in (("whole guild", None), ("one channel", 7)):
+            timings = []
+            for query in queries:
+                started = time.perf_counter()
+                index.search(query, TOP_K, channel_id)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"{label:>14}  {percentile(timings, 50):>9.2f}  {percentile(timings, 95):>9.2f}  "
+                  f"{percentile(timings, 99):>9.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Micro-benchmark: Aho-Corasick TriggerMatcher vs. the old linear trigger scan
+
+The matcher uses its default scan_threshold, so small trigger sets go
+through the plain substring scan just as they do in the bot; the "path"
+column says which one ran. "memory" is what the matcher holds once its
+first lookup has run: the trie plus, for the automaton, its failure links
+and output lists. Run from the repository root:
+    python benchmarks/bench_triggers.py
+"""
+import os
+import random
+import string
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOGS_CHANNEL_ID', '0')
+
+from bot import TriggerMatcher  # noqa: E402
+
+MESSAGES = 2000
+TRIGGER_COUNTS = [10, 100, 250, 400, 500, 1000, 5000]
+
+def random_word(rng: random.Random) -> str:
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+
+def linear_scan(triggers, text):
+    """The matching loop on_message used before TriggerMatcher"""
+    for trigger in triggers:
+        if trigger in text:
+            return trigger
+    return None
+
+def main():
+    rng = random.Random(42)
+    vocabulary = [random_word(rng) for _ in range(5000)]
+    messages = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 40))) for _ in range(MESSAGES)]
+    
+    print(f"{'triggers':>8}  {'path':>9}  {'memory':>9}  {'linear (us/msg)':>16}  {'matcher (us/msg)':>17}  "
+          f"{'speedup':>8}")
+    for count in TRIGGER_COUNTS:
+        triggers = list(dict.fromkeys(
+            ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 2))) for _ in range(count)
+        ))
+        tracemalloc.start()
+        matcher = TriggerMatcher()
+        for trigger in triggers:
+            matcher.add(trigger)
+        matcher.find("")  # The first lookup builds the automaton
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        scanning = len(matcher) <= matcher.scan_threshold and not matcher.word_boundary
+            
+        # Both approaches must agree before timing them
+        for text in messages:
+            assert matcher.find(text) == linear_scan(triggers, text), text
+            
+        linear = min(timeit.repeat(lambda: [linear_scan(triggers, m) for m in messages], number=1, repeat=3))
+        compiled = min(timeit.repeat(lambda: [matcher.find(m) for m in messages], number=1, repeat=3))
+        print(f"{len(triggers):>8}  {'scan' if scanning else 'automaton':>9}  {memory / 1024:>7.0f}KB  "
+              f"{linear / MESSAGES * 1e6:>16.1f}  {compiled / MESSAGES * 1e6:>17.1f}  {linear / compiled:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
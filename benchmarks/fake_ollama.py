@@ -0,0 +1,193 @@
+"""A fake Ollama server for trying the bot (and its backend pool) without a GPU
+
+Speaks enough of the Ollama API for the bot: /api/generate and /api/chat
+(streaming and not), /api/embed, /api/tags and /api/ps. Replies are canned
+text produced at a configurable latency and token rate, and a host can be
+told to fail a share of requests or go down entirely to exercise failover.
+Run a couple and point the bot at them:
+    python benchmarks/fake_ollama.py --port 11501
+    python benchmarks/fake_ollama.py --port 11502 --fail-rate 0.5
+    OLLAMA_API_URLS=http://localhost:11501,http://localhost:11502 python bot.py
+
+GET /fake/stats shows how many requests a host has served, and
+POST /fake/down and /fake/up toggle whether it answers at all.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+
+from aiohttp import web
+
+REPLY = "Sounds good to me! Let's squad up later and see how it goes 🎮"
+EMBEDDING_DIM = 256
+
+class FakeOllama:
+    """State and handlers for one fake Ollama host"""
+
+    def __init__(self, models=("deepseek-r1:latest", "nomic-embed-text:latest"), latency: float = 0.2,
+                 tokens_per_second: float = 50, fail_rate: float = 0.0, reply: str = REPLY, seed=None):
+        self.models = list(models)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.fail_rate = fail_rate
+        self.reply = reply
+        self.down = False
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/api/generate', self.generate)
+        app.router.add_post('/api/chat', self.generate)
+        app.router.add_post('/api/embed', self.embed)
+        app.router.add_get('/api/tags', self.tags)
+        app.router.add_get('/api/ps', self.ps)
+        app.router.add_get('/fake/stats', self.stats)
+        app.router.add_post('/fake/down', self.set_down)
+        app.router.add_post('/fake/up', self.set_up)
+        return app
+
+    def tokens(self):
+        return [word + ' ' for word in self.reply.split(' ')]
+
+    def chunk(self, chat: bool, model: str, text: str, done: bool, **extra) -> dict:
+        data = {"model": model, "created_at": time.strftime('%Y-%m-%dT%H:%M:%SZ'), "done": done}
+        if chat:
+            data["message"] = {"role": "assistant", "content": text}
+        else:
+            data["response"] = text
+        data.update(extra)
+        return data
+
+    def final_stats(self, token_count: int, started: float) -> dict:
+        elapsed = int((time.perf_counter() - started) * 1e9)
+        eval_duration = int(token_count / self.tokens_per_second * 1e9) if self.tokens_per_second else 0
+        return {"total_duration": elapsed, "load_duration": 0, "prompt_eval_count": 32,
+                "prompt_eval_duration": int(self.latency * 1e9), "eval_count": token_count,
+                "eval_duration": eval_duration}
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        body = await request.json()
+        self.requests += 1
+        if body.get('model') not in self.models:
+            return web.json_response({"error": f"model '{body.get('model')}' not found"}, status=404)
+        if self.fail_rate and self.rng.random() < self.fail_rate:
+            self.failures += 1
+            return web.json_response({"error": "simulated failure"}, status=500)
+
+        chat = request.path.endswith('/chat')
+        model = body['model']
+        tokens = self.tokens()
+        started = time.perf_counter()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            delay = 1 / self.tokens_per_second if self.tokens_per_second else 0
+            if not body.get('stream', True):
+                await asyncio.sleep(delay * len(tokens))
+                return web.json_response(self.chunk(chat, model, ''.join(tokens).strip(), True,
+                                                    **self.final_stats(len(tokens), started)))
+
+            response = web.StreamResponse()
+            response.content_type = 'application/x-ndjson'
+            await response.prepare(request)
+            for token in tokens:
+                await asyncio.sleep(delay)
+                await response.write((json.dumps(self.chunk(chat, model, token, False)) + '\n').encode())
+            final = self.chunk(chat, model, '', True, **self.final_stats(len(tokens), started))
+            await response.write((json.dumps(final) + '\n').encode())
+            await response.write_eof()
+            return response
+        except asyncio.CancelledError:
+            # The client hung up: a real Ollama stops generating here too
+            self.cancelled += 1
+            raise
+        except ConnectionResetError:
+            self.cancelled += 1
+            return response
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def embedding(text: str) -> list:
+        """Hashed bag-of-words vector, so texts sharing words come out similar"""
+        vector = [0.0] * EMBEDDING_DIM
+        for word in text.lower().split():
+            digest = hashlib.md5(word.strip('.,!?').encode()).digest()
+            vector[int.from_bytes(digest[:4], 'little') % EMBEDDING_DIM] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    async def embed(self, request: web.Request) -> web.Response:
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        body = await request.json()
+        self.requests += 1
+        model = body.get('model', '')
+        if (model if ':' in model else f"{model}:latest") not in self.models:
+            return web.json_response({"error": f"model '{model}' not found"}, status=404)
+        inputs = body.get('input', [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        await asyncio.sleep(self.latency / 10)
+        return web.json_response({"model": model, "embeddings": [self.embedding(text) for text in inputs]})
+
+    async def tags(self, request: web.Request) -> web.Response:
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        return web.json_response({"models": [{"name": model, "model": model} for model in self.models]})
+
+    async def ps(self, request: web.Request) -> web.Response:
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        return web.json_response({"models": [{"name": model, "model": model} for model in self.models]})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "failures": self.failures,
+                                  "in_flight": self.in_flight, "max_in_flight": self.max_in_flight,
+                                  "cancelled": self.cancelled, "down": self.down})
+
+    async def set_down(self, request: web.Request) -> web.Response:
+        self.down = True
+        return web.json_response({"down": True})
+
+    async def set_up(self, request: web.Request) -> web.Response:
+        self.down = False
+        return web.json_response({"down": False})
+
+async def start_fake_ollama(port: int, **options):
+    """Start a fake host on localhost in the running loop; returns (FakeOllama, AppRunner)"""
+    fake = FakeOllama(**options)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    return fake, runner
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--models', default='deepseek-r1:latest,nomic-embed-text:latest',
+                        help='Comma-separated models this host has')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Share of requests answered with a 500')
+    args = parser.parse_args()
+
+    fake = FakeOllama(models=args.models.split(','), latency=args.latency,
+                      tokens_per_second=args.tokens_per_second, fail_rate=args.fail_rate)
+    print(f"Fake Ollama on http://localhost:{args.port} with {', '.join(fake.models)}")
+    web.run_app(fake.app(), host='localhost', port=args.port, print=None)
+
+if __name__ == '__main__':
+    main()
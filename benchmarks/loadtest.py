@@ -0,0 +1,372 @@
+"""Load test: replay synthetic Discord traffic through the bot against a fake Ollama
+
+Starts benchmarks/fake_ollama.py in-process and points the bot at it, then
+drives the real handlers with stand-in Discord objects (nothing connects to
+Discord):
+    chat      on_message with a stream of channel messages, some of them
+              containing a smart-response trigger
+    dm        the ?dm command for a list of members
+    mass_dm   the ?mass_dm command, i.e. a whole DM campaign for a role
+    schedule  MessageScheduler.deliver_due with a backlog of due messages
+For each scenario it prints messages per second, end-to-end latency
+percentiles, peak memory and how many Ollama calls each message cost.
+State, campaigns and retrieval memory go to a temporary directory. Rate
+limits are raised and campaign pacing is turned off so the bot's own
+pipeline is measured; set the usual environment variables to override.
+Run from the repository root:
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --scenarios chat --messages 2000 --rate 100 --latency 0.5
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_ollama import start_fake_ollama  # noqa: E402
+
+SCENARIOS = ("chat", "dm", "mass_dm", "schedule")
+TRIGGER = "ranked tonight"
+WORDS = ("yo", "anyone", "playing", "later", "that", "boss", "fight", "was", "wild", "need", "help", "with",
+         "the", "quest", "lol", "gg", "who", "is", "on", "server", "patch", "notes", "dropped", "new", "map")
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def peak_rss_mb(kempai):
+    """Peak resident memory of the process so far, falling back to the current figure"""
+    try:
+        import resource
+    except ImportError:
+        return kempai.memory_usage_mb()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+class Recorder:
+    """Collects when each outgoing Discord message was sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def record(self):
+        self.sent.append(time.perf_counter())
+
+class Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+class SentMessage:
+    _next_id = 10 ** 9
+
+    def __init__(self, channel, content):
+        SentMessage._next_id += 1
+        self.id = SentMessage._next_id
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None):
+        self.content = content
+
+    async def delete(self):
+        pass
+
+class Permissions:
+    def __init__(self, administrator: bool):
+        self.administrator = administrator
+
+class Role:
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+        self.mention = f"<@&{role_id}>"
+        self.members = []
+
+class Member:
+    def __init__(self, member_id: int, guild, roles, recorder: Recorder, administrator: bool = False):
+        self.id = member_id
+        self.name = f"player{member_id}"
+        self.mention = f"<@{member_id}>"
+        self.guild = guild
+        self.roles = roles
+        self.bot = False
+        self.status = "online"
+        self.activity = None
+        self.guild_permissions = Permissions(administrator)
+        self.recorder = recorder
+
+    def __str__(self):
+        return self.name
+
+    def get_role(self, role_id: int):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def send(self, content):
+        self.recorder.record()
+        return SentMessage(None, content)
+
+class Channel:
+    def __init__(self, channel_id: int, guild, recorder: Recorder):
+        self.id = channel_id
+        self.name = f"chat-{channel_id}"
+        self.mention = f"<#{channel_id}>"
+        self.guild = guild
+        self.recorder = recorder
+
+    def typing(self):
+        return Typing()
+
+    async def send(self, content=None):
+        self.recorder.record()
+        return SentMessage(self, content)
+
+    def get_partial_message(self, message_id: int):
+        return SentMessage(self, None)
+
+class Guild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = "Load Test"
+        self.owner_id = 1
+        self.chunked = True
+        self.members = {}
+        self.channels = {}
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    async def fetch_member(self, member_id: int):
+        return self.members[member_id]
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+class Message:
+    _next_id = 1
+
+    def __init__(self, author, channel, content: str):
+        Message._next_id += 1
+        self.id = Message._next_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.created_at = None
+        self.mentions = []
+        self.reference = None
+
+    async def reply(self, content):
+        return await self.channel.send(content)
+
+    async def add_reaction(self, emoji):
+        pass
+
+class Context:
+    """Just enough of commands.Context for the command callbacks"""
+
+    def __init__(self, author, channel):
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.message = Message(author, channel, "")
+
+    def typing(self):
+        return Typing()
+
+    async def send(self, content):
+        return await self.channel.send(content)
+
+class Scenario:
+    """Runs one traffic pattern and reports on it"""
+
+    def __init__(self, kempai, fake, args):
+        self.kempai = kempai
+        self.fake = fake
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.posts = Recorder()  # Channel messages and replies
+        self.dms = Recorder()
+        self.guild = Guild(1)
+        self.role = Role(500, "raiders")
+        self.channels = [Channel(100 + i, self.guild, self.posts) for i in range(args.channels)]
+        for channel in self.channels:
+            self.guild.channels[channel.id] = channel
+        self.admin = Member(1, self.guild, [], self.dms, administrator=True)
+        # Most members of a role share the same role set, as on a real server
+        extra_roles = [Role(501 + i, name) for i, name in enumerate(("tank", "healer", "dps", "casual"))]
+        self.users = [Member(1000 + i, self.guild, [self.role] + self.rng.sample(extra_roles, self.rng.randint(0, 1)),
+                             self.dms) for i in range(args.users)]
+        for member in [self.admin] + self.users:
+            self.guild.members[member.id] = member
+        self.role.members = list(self.users)
+        kempai.bot.get_guild = lambda guild_id: self.guild if guild_id == self.guild.id else None
+        kempai.bot.get_channel = self.guild.get_channel
+
+    def text(self) -> str:
+        words = [self.rng.choice(WORDS) for _ in range(self.rng.randint(3, 25))]
+        if self.rng.random() < self.args.trigger_share:
+            words.insert(self.rng.randrange(len(words) + 1), TRIGGER)
+        return ' '.join(words)
+
+    async def idle(self):
+        """Wait until no reply is pending, queued or generating"""
+        kempai = self.kempai
+        quiet = 0
+        while quiet < 3:
+            busy = (kempai.message_debouncer._pending or kempai.generation_tracker.generations or
+                    kempai.inference_scheduler.active or kempai.inference_scheduler.waiting or
+                    self.fake.in_flight)
+            quiet = 0 if busy else quiet + 1
+            await asyncio.sleep(0.01)
+
+    async def chat(self):
+        kempai = self.kempai
+        interval = 1 / self.args.rate if self.args.rate else 0
+        started = time.perf_counter()
+        for index in range(self.args.messages):
+            message = Message(self.rng.choice(self.users), self.rng.choice(self.channels), self.text())
+            message.created_at = kempai.discord.utils.utcnow()
+            await kempai.on_message(message)
+            if interval:
+                # Keep to the schedule rather than sleeping a fixed gap after each message
+                delay = started + (index + 1) * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)
+        await self.idle()
+        histogram = kempai.metrics.histogram("kempai_stage_seconds", stage="end_to_end")
+        return self.args.messages, list(histogram.recent) if histogram else []
+
+    async def dm(self):
+        members = self.users[:self.args.members]
+        ctx = Context(self.admin, self.channels[0])
+        self.dms.sent.clear()
+        started = time.perf_counter()
+        await self.kempai.dm.callback(ctx, members, message="Raid night is moved to Friday at 8pm, bring potions")
+        return len(members), [sent - started for sent in self.dms.sent]
+
+    async def mass_dm(self):
+        kempai = self.kempai
+        self.role.members = self.users[:self.args.members]
+        ctx = Context(self.admin, self.channels[0])
+        self.dms.sent.clear()
+        started = time.perf_counter()
+        await kempai.mass_dm.callback(ctx, self.role, message="Server maintenance tonight from 2am, expect downtime")
+        await asyncio.gather(*kempai.campaign_manager._tasks.values())
+        return len(self.role.members), [sent - started for sent in self.dms.sent]
+
+    async def schedule(self):
+        scheduler = self.kempai.message_scheduler
+        now = time.time()
+        for index in range(self.args.scheduled):
+            channel = self.channels[index % len(self.channels)]
+            scheduler.add(channel.id, f"Reminder #{index}: daily quests reset soon", now - 1, self.admin.id,
+                          self.guild.id)
+        self.posts.sent.clear()
+        started = time.perf_counter()
+        await scheduler.deliver_due(now)
+        return self.args.scheduled, [sent - started for sent in self.posts.sent]
+
+    async def run(self, name: str):
+        self.kempai.metrics.histograms.clear()
+        requests_before = self.fake.requests
+        if self.args.tracemalloc:
+            tracemalloc.start()
+        started = time.perf_counter()
+        count, latencies = await getattr(self, name)()
+        elapsed = time.perf_counter() - started
+        heap_peak = None
+        if self.args.tracemalloc:
+            heap_peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+        calls = self.fake.requests - requests_before
+        rss = peak_rss_mb(self.kempai)
+        print(f"{name:>8}  {count:>6}  {count / elapsed:>8.1f}  "
+              f"{percentile(latencies, 50) * 1000:>8.1f}  {percentile(latencies, 90) * 1000:>8.1f}  "
+              f"{percentile(latencies, 99) * 1000:>8.1f}  {calls / count if count else 0:>9.2f}  "
+              f"{f'{rss:.0f}' if rss is not None else '?':>8}"
+              + (f"  {heap_peak:>8.1f}" if heap_peak is not None else ""))
+
+async def run(args):
+    fake, runner = await start_fake_ollama(args.port, latency=args.latency,
+                                           tokens_per_second=args.tokens_per_second, seed=args.seed)
+    import bot as kempai
+    kempai.state_store.open()
+    kempai.load_state()
+    kempai.state_store.start()
+    await kempai.ollama_client.start()
+    kempai.ollama_pool.start()
+    kempai.retrieval_memory.start()
+    try:
+        scenario = Scenario(kempai, fake, args)
+        kempai.save_smart_response(scenario.guild.id, TRIGGER, "Hype them up for ranked games tonight")
+        print(f"Fake Ollama: {args.latency * 1000:.0f} ms to first token, {args.tokens_per_second:g} tokens/s, "
+              f"{kempai.INFERENCE_CONCURRENCY} concurrent generations, {kempai.DEBOUNCE_MS} ms debounce")
+        print(f"{'scenario':>8}  {'msgs':>6}  {'msgs/s':>8}  {'p50 ms':>8}  {'p90 ms':>8}  {'p99 ms':>8}  "
+              f"{'calls/msg':>9}  {'peak MB':>8}" + (f"  {'heap MB':>8}" if args.tracemalloc else ""))
+        for name in args.scenarios:
+            await scenario.run(name)
+    finally:
+        await kempai.retrieval_memory.close()
+        await kempai.ollama_pool.close()
+        await kempai.ollama_client.close()
+        await kempai.state_store.close()
+        await runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma-separated scenarios to run ({', '.join(SCENARIOS)})")
+    parser.add_argument('--port', type=int, default=11599, help='Port for the fake Ollama')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50)
+    parser.add_argument('--messages', type=int, default=500, help='Chat messages to replay')
+    parser.add_argument('--rate', type=float, default=50, help='Chat messages per second (0 = as fast as possible)')
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--trigger-share', type=float, default=0.1, help='Share of chat messages with a trigger')
+    parser.add_argument('--members', type=int, default=50, help='Recipients for dm and mass_dm')
+    parser.add_argument('--scheduled', type=int, default=1000, help='Due messages for schedule')
+    parser.add_argument('--tracemalloc', action='store_true', help='Also report the Python heap peak (slower)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.members = min(args.members, args.users)
+
+    # The bot reads its config at import time, so point it at the fake before importing it
+    directory = tempfile.TemporaryDirectory(prefix='kempai-loadtest-')
+    url = f"http://localhost:{args.port}/api/generate"
+    os.environ['OLLAMA_API_URL'] = url
+    os.environ['OLLAMA_API_URLS'] = url
+    os.environ['STATE_DB_PATH'] = os.path.join(directory.name, 'state.db')
+    os.environ['CAMPAIGN_DIR'] = os.path.join(directory.name, 'campaigns')
+    os.environ['RETRIEVAL_DIR'] = os.path.join(directory.name, 'memory')
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['LOGS_CHANNEL_ID'] = '0'  # Nothing to log to
+    os.environ.setdefault('METRICS_WINDOW', str(max(args.messages, args.members, args.scheduled)))
+    os.environ.setdefault('CAMPAIGN_SEND_INTERVAL', '0')
+    os.environ.setdefault('CAMPAIGN_STATUS_INTERVAL', '3600')
+    for scope in ('USER', 'CHANNEL', 'GUILD'):
+        os.environ.setdefault(f'RATE_LIMIT_{scope}_PER_MINUTE', '1000000')
+        os.environ.setdefault(f'RATE_LIMIT_{scope}_BURST', '1000000')
+    with directory:
+        asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
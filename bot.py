@@ -1,22 +1,161 @@
 import os
+import sys
+import argparse
+import subprocess
+import tempfile
 import asyncio
 import json
+import re
 from typing import List, Dict, Set, Optional
 import aiohttp
+from aiohttp import web
 from dotenv import load_dotenv
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 import datetime
 import random
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+import bisect
+import time
+import uuid
+import heapq
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Only needed for retrieval memory
 
 # Load environment variables
 load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-OLLAMA_API_URL = os.getenv('OLLAMA_API_URL')
+OLLAMA_API_URL = os.getenv('OLLAMA_API_URL', 'http://localhost:11434/api/generate')
+OLLAMA_USE_CHAT_API = os.getenv('OLLAMA_USE_CHAT_API', 'true').lower() == 'true'  # Structured chat messages for conversations
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')  # How long Ollama keeps the model loaded after a request (-1 = forever)
+if OLLAMA_KEEP_ALIVE.lstrip('-').isdigit():
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)  # Ollama only takes bare seconds (and -1) as a JSON number
+OLLAMA_WARMUP = os.getenv('OLLAMA_WARMUP', 'true').lower() == 'true'  # Preload the model on startup and after ?setmodel
+OLLAMA_UNLOAD_PREVIOUS = os.getenv('OLLAMA_UNLOAD_PREVIOUS', 'false').lower() == 'true'  # Free the old model after ?setmodel
+OLLAMA_KEEP_WARM = os.getenv('OLLAMA_KEEP_WARM', 'false').lower() == 'true'  # Reload the model whenever a host unloads it
 MODEL_NAME = os.getenv('OLLAMA_MODEL', 'deepseek-r1:latest')  # Default to llama2 if not specified
 LOGS_CHANNEL_ID = int(os.getenv('LOGS_CHANNEL_ID'))  # Channel ID for logging admin actions
 
+# Ollama HTTP client settings (one pooled session is shared for the bot's lifetime)
+OLLAMA_MAX_CONNECTIONS = int(os.getenv('OLLAMA_MAX_CONNECTIONS', '20'))  # Total pooled connections
+OLLAMA_MAX_CONNECTIONS_PER_HOST = int(os.getenv('OLLAMA_MAX_CONNECTIONS_PER_HOST', '10'))  # Connections per Ollama host
+OLLAMA_KEEPALIVE_TIMEOUT = float(os.getenv('OLLAMA_KEEPALIVE_TIMEOUT', '60'))  # Seconds an idle connection is kept open
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '10'))  # Seconds to establish a connection
+OLLAMA_REQUEST_TIMEOUT = float(os.getenv('OLLAMA_REQUEST_TIMEOUT', '300'))  # Seconds for a whole request
+
+# Ollama backends (requests go to the least busy healthy host that has the model)
+OLLAMA_API_URLS = [url.strip() for url in os.getenv('OLLAMA_API_URLS', '').split(',') if url.strip()] or [OLLAMA_API_URL]
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '15'))  # Seconds between health probes
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv('OLLAMA_HEALTH_TIMEOUT', '5'))  # Seconds before a probe counts as failed
+OLLAMA_FAILURE_THRESHOLD = int(os.getenv('OLLAMA_FAILURE_THRESHOLD', '3'))  # Failures in a row before a host is ejected
+OLLAMA_EJECT_SECONDS = float(os.getenv('OLLAMA_EJECT_SECONDS', '30'))  # Seconds an ejected host rests before a retry
+
+# Model routing (light requests go to a small fast model, real questions to OLLAMA_MODEL)
+OLLAMA_LIGHT_MODEL = os.getenv('OLLAMA_LIGHT_MODEL', '')  # Small fast model; unset sends everything to OLLAMA_MODEL
+ROUTING_LIGHT_KINDS = [kind.strip() for kind in os.getenv('ROUTING_LIGHT_KINDS', 'trigger,dm,summary').split(',') if kind.strip()]
+ROUTING_HEAVY_MIN_LENGTH = int(os.getenv('ROUTING_HEAVY_MIN_LENGTH', '200'))  # Chat messages this long go to the main model
+ROUTING_QUESTION_MIN_WORDS = int(os.getenv('ROUTING_QUESTION_MIN_WORDS', '8'))  # Questions with this many words go to the main model
+ROUTING_QUEUE_DEPTH = int(os.getenv('ROUTING_QUEUE_DEPTH', '0'))  # Waiting requests before all chat goes light; 0 = never
+
+# Streaming replies (post as soon as tokens arrive, then edit the message as more come in)
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() == 'true'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))  # Min seconds between edits (Discord rate limits)
+DISCORD_MESSAGE_LIMIT = 2000  # Max characters in a single Discord message
+
+# Conversation memory limits
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '1500'))  # Approx. tokens of raw history kept per channel
+HISTORY_MAX_CHANNELS = int(os.getenv('HISTORY_MAX_CHANNELS', '500'))  # Channels remembered before idle ones are dropped
+HISTORY_SUMMARIES = os.getenv('HISTORY_SUMMARIES', 'true').lower() == 'true'  # Summarize evicted turns in the background
+HISTORY_SUMMARY_TOKENS = int(os.getenv('HISTORY_SUMMARY_TOKENS', '200'))  # Approx. token cap for a channel's rolling summary
+
+# Retrieval memory (embeds past turns and recalls the most relevant ones; needs numpy)
+RETRIEVAL_MEMORY = os.getenv('RETRIEVAL_MEMORY', 'false').lower() == 'true'
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'nomic-embed-text')  # Ollama embedding model
+RETRIEVAL_DIR = os.getenv('RETRIEVAL_DIR', 'memory')  # Where the per-guild vector files live
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '4'))  # Past turns added to each prompt at most
+RETRIEVAL_MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE', '0.35'))  # Cosine similarity a turn needs to be recalled
+RETRIEVAL_SCOPE = os.getenv('RETRIEVAL_SCOPE', 'channel')  # channel (recall only from the same channel) or guild
+RETRIEVAL_MIN_LENGTH = int(os.getenv('RETRIEVAL_MIN_LENGTH', '20'))  # Shorter turns aren't worth embedding
+RETRIEVAL_QUERY_TIMEOUT = float(os.getenv('RETRIEVAL_QUERY_TIMEOUT', '2'))  # Seconds to wait for a query embedding
+
+# Audit log batching (log entries are queued and written to the log channel in the background)
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '5'))  # Seconds between log channel flushes
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', '10'))  # Entries per log message; a full batch flushes early
+LOG_QUEUE_MAX = int(os.getenv('LOG_QUEUE_MAX', '1000'))  # Pending entries before new ones are dropped
+LOG_PRESSURE_THRESHOLD = int(os.getenv('LOG_PRESSURE_THRESHOLD', '200'))  # Pending entries before chat logs are sampled
+LOG_CHAT_SAMPLE_RATE = float(os.getenv('LOG_CHAT_SAMPLE_RATE', '0.1'))  # Share of chat logs kept under pressure
+
+# Inference scheduling (how much work is sent to Ollama at once)
+INFERENCE_CONCURRENCY = int(os.getenv('INFERENCE_CONCURRENCY', '2'))  # Generations running at the same time
+INFERENCE_MAX_QUEUE = int(os.getenv('INFERENCE_MAX_QUEUE', '50'))  # Waiting requests before new chat gets a "busy" reply
+INFERENCE_MAX_CHANNEL_QUEUE = int(os.getenv('INFERENCE_MAX_CHANNEL_QUEUE', '5'))  # Waiting requests allowed per channel
+
+# Smart response matching
+TRIGGER_WORD_BOUNDARY = os.getenv('TRIGGER_WORD_BOUNDARY', 'false').lower() == 'true'  # Only match triggers as whole words
+
+# Response cache for smart responses (off unless enabled)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '256'))  # Cached responses kept before the oldest is evicted
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))  # Seconds a cached response stays valid
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'  # Share one generation between identical in-flight prompts
+
+# Mass DM campaigns
+CAMPAIGN_DIR = os.getenv('CAMPAIGN_DIR', 'campaigns')  # Where campaign progress is saved so it survives restarts
+CAMPAIGN_WORKERS = int(os.getenv('CAMPAIGN_WORKERS', '3'))  # Personalized messages generated in parallel per campaign
+CAMPAIGN_SEND_INTERVAL = float(os.getenv('CAMPAIGN_SEND_INTERVAL', '1.0'))  # Min seconds between DMs
+CAMPAIGN_STATUS_INTERVAL = float(os.getenv('CAMPAIGN_STATUS_INTERVAL', '10'))  # Seconds between status message updates
+CAMPAIGN_MAX_RETRIES = int(os.getenv('CAMPAIGN_MAX_RETRIES', '3'))  # Attempts per DM on Discord errors
+PERSONALIZE_BY_GROUP = os.getenv('PERSONALIZE_BY_GROUP', 'true').lower() == 'true'  # One generation per role set for ?dm and ?mass_dm
+
+# Engagement gate (which messages the bot answers; can be overridden per guild with ?engagement)
+ENGAGEMENT_MODE = os.getenv('ENGAGEMENT_MODE', 'all')  # all, mention (mentions or replies to the bot), reply
+ENGAGEMENT_MIN_LENGTH = int(os.getenv('ENGAGEMENT_MIN_LENGTH', '1'))  # Shorter messages never get an AI reply
+ENGAGEMENT_MODES = ("all", "mention", "reply")
+
+# Rate limits for AI replies (token buckets: sustained rate per minute plus a burst allowance)
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv('RATE_LIMIT_USER_PER_MINUTE', '6'))
+RATE_LIMIT_USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', '3'))
+RATE_LIMIT_CHANNEL_PER_MINUTE = float(os.getenv('RATE_LIMIT_CHANNEL_PER_MINUTE', '20'))
+RATE_LIMIT_CHANNEL_BURST = int(os.getenv('RATE_LIMIT_CHANNEL_BURST', '8'))
+RATE_LIMIT_GUILD_PER_MINUTE = float(os.getenv('RATE_LIMIT_GUILD_PER_MINUTE', '60'))
+RATE_LIMIT_GUILD_BURST = int(os.getenv('RATE_LIMIT_GUILD_BURST', '20'))
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv('RATE_LIMIT_MAX_BUCKETS', '10000'))  # Buckets kept per scope before the idlest is dropped
+
+# Debouncing (rapid-fire messages in a channel are answered with one reply)
+DEBOUNCE_MS = int(os.getenv('DEBOUNCE_MS', '750'))  # Quiet time before replying; 0 replies to every message at once
+DEBOUNCE_PER_QUEUED_MS = int(os.getenv('DEBOUNCE_PER_QUEUED_MS', '250'))  # Extra wait per request queued for Ollama
+DEBOUNCE_MAX_MS = int(os.getenv('DEBOUNCE_MAX_MS', '4000'))  # Longest the window can stretch to
+
+# Generation deadlines
+GENERATION_TIMEOUT = float(os.getenv('GENERATION_TIMEOUT', '120'))  # Seconds a generation may take, queueing included
+
+# Gateway intents and member cache (the defaults keep memory low on large servers)
+DISCORD_PRESENCE_INTENT = os.getenv('DISCORD_PRESENCE_INTENT', 'false').lower() == 'true'  # Member status/activity updates
+DISCORD_MEMBERS_INTENT = os.getenv('DISCORD_MEMBERS_INTENT', 'true').lower() == 'true'  # Join events and member lists
+MEMBER_CACHE = os.getenv('MEMBER_CACHE', 'joined')  # all (every member), joined (members who join or are fetched), none
+CHUNK_GUILDS_AT_STARTUP = os.getenv('CHUNK_GUILDS_AT_STARTUP', 'false').lower() == 'true'  # Download every member on connect
+
+# Sharding and inference workers (see `python bot.py launch --help` to run several processes)
+BOT_SHARDING = os.getenv('BOT_SHARDING', 'false').lower() == 'true'  # Run as an AutoShardedBot
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) or None  # Total shards across all processes; unset lets Discord decide
+SHARD_IDS = [int(shard) for shard in os.getenv('SHARD_IDS', '').split(',') if shard.strip()] or None  # This process's shards
+INFERENCE_WORKER_SOCKETS = [path.strip() for path in os.getenv('INFERENCE_WORKER_SOCKETS', '').split(',') if path.strip()]
+INFERENCE_WORKER_MESSAGE_LIMIT = 16 * 1024 * 1024  # Longest JSON line on a worker socket
+
+# Metrics (Prometheus-style /metrics endpoint plus ?stats)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Port for the /metrics endpoint; 0 turns the endpoint off
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # Interface the endpoint listens on
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', '1024'))  # Recent samples per histogram used for percentiles
+
+# Persistent state
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')  # SQLite database for triggers, history, schedules, etc.
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '1.0'))  # Seconds between batched writes to the database
+
 # Bot Personality Configuration
 BOT_NAME = "KempAI"  # The bot's preferred name
 BOT_PRONOUNS = "OMEN"  # Gender-neutral pronouns
@@ -43,6 +182,22 @@ BOT_GUIDELINES = {
     ]
 }
 
+# System prompt built once so every request shares the same cacheable prefix
+SYSTEM_PROMPT = f"""You are {BOT_NAME}, a Discord co-owner and moderator. {BOT_BACKSTORY}
+
+Personality traits:
+- {BOT_PERSONALITY_TRAITS['gaming_level']}
+- {BOT_PERSONALITY_TRAITS['moderation_style']}
+- {BOT_PERSONALITY_TRAITS['humor_type']}
+- {BOT_PERSONALITY_TRAITS['energy_level']}
+
+Response Guidelines:
+- Respond directly and naturally without any thinking out loud
+- Avoid being overly formal or robotic
+- Never use <think> tags or show your thought process
+
+As a co-owner, try to be helpful but not overbearing. Keep responses short and fun."""
+
 # Fun responses with the bot's personality
 success_reactions = ['👌', '✅', '💪', '🎮', '🔥', '💯']
 greeting_messages = [
@@ -58,34 +213,1309 @@ FRIENDLY_ERRORS = {
     "no_perms": "Oof, looks like you need admin powers for that one! 🚫",
     "bot_no_perms": "Ah snap, I don't have the right permissions for that! 😔",
     "invalid_user": "Can't find that player in our server! 🤔",
-    "higher_role": "Can't modify someone with a higher role than you! That's like trying to beat the final boss at level 1! 😅"
+    "higher_role": "Can't modify someone with a higher role than you! That's like trying to beat the final boss at level 1! 😅",
+    "busy": "Whoa, lobby's full right now! I'm juggling a ton of convos - try me again in a sec ⏳",
+    "timeout": "Yikes, my brain lagged out on that one and timed out! Mind asking again? 🐌",
+    "ollama_down": "My brain's server is taking a nap right now 😴 Give me a minute and try again!"
 }
 
-# Initialize bot with all intents for full functionality
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="?", intents=intents)
+class KempAIBot(commands.AutoShardedBot if BOT_SHARDING else commands.Bot):
+    """Bot subclass that owns the lifetime of shared resources like the Ollama client"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ready_seconds: Optional[float] = None  # Time from process start to the first on_ready
+
+    async def setup_hook(self):
+        """Create long-lived resources once, before connecting to the gateway"""
+        state_store.open()
+        load_state()
+        state_store.start()
+        await ollama_client.start()
+        ollama_pool.start()
+        model_warmer.start()
+        retrieval_memory.start()
+        await metrics.start()
+        audit_log.start()
+        message_scheduler.start()
+
+    async def close(self):
+        """Shut down the gateway connection, then release shared resources"""
+        await message_scheduler.close()
+        await audit_log.close()
+        await super().close()
+        await metrics.close()
+        await model_warmer.close()
+        await retrieval_memory.close()
+        if inference_client is not ollama_pool:
+            await inference_client.close()
+        await ollama_pool.close()
+        await ollama_client.close()
+        await state_store.close()
+
+def build_intents() -> discord.Intents:
+    """Gateway intents from the config; message content is always needed"""
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = DISCORD_MEMBERS_INTENT
+    intents.presences = DISCORD_PRESENCE_INTENT
+    return intents
+
+def build_member_cache_flags(intents: discord.Intents) -> discord.MemberCacheFlags:
+    """Member cache flags for MEMBER_CACHE, limited to what the intents allow"""
+    if MEMBER_CACHE == "all":
+        return discord.MemberCacheFlags.from_intents(intents)
+    flags = discord.MemberCacheFlags.none()
+    if MEMBER_CACHE == "joined" and intents.members:
+        flags.joined = True
+    return flags
+
+# Process start, for measuring time-to-ready
+STARTED_AT = time.monotonic()
+
+def owns_guild(guild_id: int) -> bool:
+    """Whether this process runs the shard a guild (or, for 0, DMs) is on
+
+    Always true unless SHARD_IDS splits the shards between processes.
+    """
+    if not SHARD_IDS or not SHARD_COUNT:
+        return True
+    # Discord's shard formula; DMs always arrive on shard 0
+    return ((guild_id >> 22) % SHARD_COUNT if guild_id else 0) in SHARD_IDS
+
+intents = build_intents()
+shard_options = {"shard_count": SHARD_COUNT, "shard_ids": SHARD_IDS} if BOT_SHARDING else {}
+bot = KempAIBot(
+    command_prefix="?",
+    intents=intents,
+    member_cache_flags=build_member_cache_flags(intents),
+    chunk_guilds_at_startup=CHUNK_GUILDS_AT_STARTUP and intents.members,
+    **shard_options
+)
+
+def memory_usage_mb() -> Optional[float]:
+    """Resident memory of this process in MB, or None if it can't be read"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current usage; reported in bytes on macOS and KB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+async def members_with_role(guild: discord.Guild, role: discord.Role) -> List[discord.Member]:
+    """Members who have a role, fetched from the API if the member cache is incomplete
+
+    Fetched members aren't added to the cache, so a one-off mass DM doesn't
+    leave the whole guild in memory.
+    """
+    if guild.chunked:
+        return list(role.members)
+    return [member async for member in guild.fetch_members(limit=None) if member.get_role(role.id)]
+
+# Histogram buckets: seconds for pipeline stages, tokens per second for generation speed
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+class Histogram:
+    """Prometheus-style buckets plus a window of recent samples for percentiles"""
+
+    def __init__(self, buckets: tuple, window: int = METRICS_WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # Per bucket, made cumulative when rendered
+        self.sum = 0.0
+        self.count = 0
+        self.recent: deque = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+    def percentile(self, p: float) -> float:
+        """The p-th percentile (0-100) of recent samples, 0 if there are none"""
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class Metrics:
+    """Counters and histograms for the message pipeline
+
+    Pipeline stages are timed into one histogram labelled by stage, Ollama's
+    own timing fields are turned into token rates, and gauges are read from
+    the scheduler, caches and backends when scraped. With a port set, an
+    aiohttp server exposes everything in the Prometheus text format at
+    /metrics; ?stats summarizes the same data in Discord.
+    """
+
+    STAGES = ("gate", "command", "trigger_match", "prompt_build", "queue_wait", "ollama_first_token",
+              "ollama_total", "discord_reply", "end_to_end")
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT, window: int = METRICS_WINDOW):
+        self.host = host
+        self.port = port
+        self.window = window
+        self.counters: Dict[tuple, float] = defaultdict(float)
+        self.histograms: Dict[tuple, Histogram] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def observe(self, name: str, value: float, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets, self.window)
+        histogram.observe(value)
+
+    def stage(self, stage: str, seconds: float):
+        """Record how long one pipeline stage took"""
+        self.observe("kempai_stage_seconds", seconds, stage=stage)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Time the body of a with block as a pipeline stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage(stage, time.perf_counter() - started)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self.histograms.get(self._key(name, labels))
+
+    def counter(self, name: str, **labels) -> float:
+        return self.counters.get(self._key(name, labels), 0.0)
+
+    def record_ollama_stats(self, data: Dict):
+        """Harvest the timing fields Ollama adds to a finished response (durations are in ns)"""
+        eval_count = data.get('eval_count') or 0
+        eval_duration = data.get('eval_duration') or 0
+        prompt_count = data.get('prompt_eval_count') or 0
+        prompt_duration = data.get('prompt_eval_duration') or 0
+        self.inc("kempai_ollama_eval_tokens_total", eval_count)
+        self.inc("kempai_ollama_prompt_tokens_total", prompt_count)
+        if eval_count and eval_duration:
+            self.observe("kempai_ollama_tokens_per_second", eval_count / (eval_duration / 1e9), RATE_BUCKETS)
+        if prompt_count and prompt_duration:
+            self.observe("kempai_ollama_prompt_tokens_per_second", prompt_count / (prompt_duration / 1e9),
+                         RATE_BUCKETS)
+        if 'load_duration' in data:
+            self.observe("kempai_ollama_load_seconds", (data['load_duration'] or 0) / 1e9)
+
+    def gauges(self) -> List[tuple]:
+        """(name, labels, value) read from the bot's shared objects at scrape time"""
+        stats = inference_scheduler.stats()
+        values = [
+            ("kempai_inference_active", {}, stats['active']),
+            ("kempai_inference_waiting", {}, stats['waiting']),
+            ("kempai_inference_rejected_total", {}, stats['rejected']),
+            ("kempai_response_cache_hits_total", {}, response_cache.hits),
+            ("kempai_response_cache_misses_total", {}, response_cache.misses),
+            ("kempai_single_flight_shared_total", {}, single_flight.shared),
+            ("kempai_generations_running", {}, len(generation_tracker.generations)),
+            ("kempai_generations_cancelled_total", {}, generation_tracker.cancelled),
+            ("kempai_generations_timed_out_total", {}, generation_tracker.timed_out),
+            ("kempai_audit_log_pending", {}, audit_log.pending),
+        ]
+        values.extend(("kempai_rate_limited_total", {"scope": scope}, count)
+                      for scope, count in rate_limiter.throttled_counts().items())
+        names = {ENGAGE_NONE: "ignored", ENGAGE_TRIGGERS: "triggers_only", ENGAGE_CHAT: "chat"}
+        values.extend(("kempai_messages_total", {"engagement": names[level]}, count)
+                      for level, count in engagement_counts.items())
+        for backend in ollama_pool.backends:
+            values.append(("kempai_backend_up", {"backend": backend.base_url}, int(backend.available())))
+            values.append(("kempai_backend_in_flight", {"backend": backend.base_url}, backend.outstanding))
+        rss = memory_usage_mb()
+        if rss is not None:
+            values.append(("kempai_resident_memory_bytes", {}, rss * 1024 ** 2))
+        return values
+
+    @staticmethod
+    def _format_labels(labels, extra: Optional[tuple] = None) -> str:
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{str(value)}"' for key, value in pairs) + "}"
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format"""
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._format_labels(labels, ('le', f'{bound:g}'))} {cumulative}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {self._format_value(histogram.sum)}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+        for name, labels, value in self.gauges():
+            declare(name, "counter" if name.endswith("_total") else "gauge")
+            lines.append(f"{name}{self._format_labels(sorted(labels.items()))} {self._format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        """Serve /metrics if a port is configured"""
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            print(f"Couldn't start the metrics endpoint on {self.host}:{self.port}: {str(e)}")
+            await self._runner.cleanup()
+            self._runner = None
+            return
+        print(f"Metrics available at http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+# Shared metrics; the endpoint starts in setup_hook
+metrics = Metrics()
+
+class StateStore:
+    """SQLite-backed storage for the bot's runtime state
+
+    The database runs in WAL mode so reads never wait on writes. Writes are
+    write-behind: callers queue statements and a background task commits
+    them in one transaction every flush_interval seconds on a dedicated
+    thread, so event handlers never wait on disk. Everything is keyed by
+    guild (0 for DMs).
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS trusted_users (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    CREATE TABLE IF NOT EXISTS allowed_channels (
+        guild_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, channel_id)
+    );
+    CREATE TABLE IF NOT EXISTS smart_responses (
+        guild_id INTEGER NOT NULL,
+        trigger TEXT NOT NULL,
+        template TEXT NOT NULL,
+        cacheable INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (guild_id, trigger)
+    );
+    CREATE TABLE IF NOT EXISTS message_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        guild_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS message_history_channel ON message_history (channel_id, id);
+    CREATE TABLE IF NOT EXISTS history_summaries (
+        channel_id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        summary TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS dm_conversations (
+        user_id INTEGER NOT NULL,
+        guild_id INTEGER NOT NULL,
+        last_message TEXT,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (user_id, guild_id)
+    );
+    CREATE TABLE IF NOT EXISTS guild_settings (
+        guild_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (guild_id, key)
+    );
+    CREATE TABLE IF NOT EXISTS memory_turns (
+        guild_id INTEGER NOT NULL,
+        idx INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (guild_id, idx)
+    );
+    CREATE TABLE IF NOT EXISTS scheduled_messages (
+        id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        channel_id INTEGER NOT NULL,
+        author_id INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        due REAL NOT NULL,
+        interval REAL NOT NULL DEFAULT 0
+    );
+    """
+
+    def __init__(self, path: str = STATE_DB_PATH, flush_interval: float = STATE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.writes = 0
+        self.flushes = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: List[tuple] = []
+        # One thread keeps batches committing in the order they were queued
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self._task: Optional[asyncio.Task] = None
+
+    def open(self):
+        """Open the database, switch it to WAL mode and create missing tables"""
+        if self._conn is not None:
+            return
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+
+    def query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """Run a read directly (meant for startup loading)"""
+        return self._conn.execute(sql, params).fetchall()
+
+    async def query_async(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """Run a read on the store's thread, after any writes already queued ahead of it"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.query, sql, params)
+
+    def write(self, sql: str, params: tuple = ()):
+        """Queue a write to be committed with the next batch"""
+        if self._conn is None:
+            return
+        self._pending.append((sql, params))
+
+    def _commit(self, batch: List[tuple]):
+        try:
+            self._conn.execute("BEGIN")
+            for sql, params in batch:
+                self._conn.execute(sql, params)
+            self._conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            # BEGIN itself can fail (e.g. "database is locked"), leaving nothing to roll back
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            print(f"Failed to save bot state: {e}")
+            return
+        self.writes += len(batch)
+        self.flushes += 1
+
+    async def flush(self):
+        """Commit every queued write"""
+        if not self._pending or self._conn is None:
+            return
+        batch, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._commit, batch)
+
+    def start(self):
+        """Start the background writer"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Keep the writer alive whatever goes wrong, or every later write is lost
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"State store writer error: {e}")
+
+    async def close(self):
+        """Stop the writer, commit what's left and close the database"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._conn is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._conn.close)
+            self._conn = None
+
+# Shared state store, opened in setup_hook
+state_store = StateStore()
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token) used for history budgets"""
+    return max(1, len(text) // 4)
+
+class ChannelMemory:
+    """Recent turns of one channel plus a rolling summary of older ones"""
+
+    def __init__(self, guild_id: int = 0):
+        self.guild_id = guild_id
+        self.turns: deque = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.evicted: List[Dict[str, str]] = []
+        self.summarizing = False
+
+class ConversationMemory:
+    """Per-channel conversation history with a token budget and LRU channel eviction
+
+    Each channel keeps as many recent turns as fit in token_budget. Turns that
+    fall out of the budget are folded into a short rolling summary by a
+    background task, and only max_channels channels are tracked at once, the
+    least recently active ones being forgotten first. With a store, turns and
+    summaries are saved as they change and a forgotten channel is reloaded
+    from it the next time it's active.
+    """
+
+    def __init__(self, token_budget: int = HISTORY_TOKEN_BUDGET, max_channels: int = HISTORY_MAX_CHANNELS,
+                 summarize: bool = HISTORY_SUMMARIES, summary_tokens: int = HISTORY_SUMMARY_TOKENS,
+                 store: Optional[StateStore] = None):
+        self.store = store
+        self.token_budget = token_budget
+        self.max_channels = max_channels
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self._channels: OrderedDict = OrderedDict()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._channels
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def _get(self, channel_id: int, guild_id: int = 0) -> ChannelMemory:
+        memory = self._channels.get(channel_id)
+        if memory is None:
+            memory = self._channels[channel_id] = ChannelMemory(guild_id)
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+        return memory
+
+    async def ensure_loaded(self, channel_id: int, guild_id: int = 0):
+        """Load a channel's saved turns and summary if it isn't in memory yet"""
+        if self.store is None or channel_id in self._channels:
+            return
+        # Newest rows first; a budget's worth is all that can be kept anyway
+        rows = await self.store.query_async(
+            "SELECT role, content FROM message_history WHERE channel_id = ? ORDER BY id DESC LIMIT 200",
+            (channel_id,)
+        )
+        summary_rows = await self.store.query_async(
+            "SELECT summary FROM history_summaries WHERE channel_id = ?", (channel_id,)
+        )
+        if channel_id in self._channels:
+            return  # Another message loaded it while we were reading
+            
+        memory = self._get(channel_id, guild_id)
+        for role, content in rows:
+            tokens = estimate_tokens(content)
+            if memory.turns and memory.tokens + tokens > self.token_budget:
+                break
+            memory.turns.appendleft({"role": role, "content": content})
+            memory.tokens += tokens
+        if summary_rows:
+            memory.summary = summary_rows[0][0]
+
+    def add(self, channel_id: int, role: str, content: str, guild_id: int = 0):
+        """Append a turn, evicting the oldest turns once over the token budget"""
+        memory = self._get(channel_id, guild_id)
+        memory.turns.append({"role": role, "content": content})
+        memory.tokens += estimate_tokens(content)
+        if self.store:
+            self.store.write(
+                "INSERT INTO message_history (guild_id, channel_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                (memory.guild_id, channel_id, role, content, time.time())
+            )
+        
+        # Always keep the newest turn, even if it alone is over budget
+        evicted_any = False
+        while memory.tokens > self.token_budget and len(memory.turns) > 1:
+            old = memory.turns.popleft()
+            memory.tokens -= estimate_tokens(old["content"])
+            evicted_any = True
+            if self.summarize:
+                memory.evicted.append(old)
+                
+        if evicted_any and self.store:
+            # Saved history only needs to cover what's still in memory
+            self.store.write(
+                "DELETE FROM message_history WHERE channel_id = ? AND id NOT IN "
+                "(SELECT id FROM message_history WHERE channel_id = ? ORDER BY id DESC LIMIT ?)",
+                (channel_id, channel_id, len(memory.turns))
+            )
+                
+        if memory.evicted and not memory.summarizing:
+            memory.summarizing = True
+            task = asyncio.get_running_loop().create_task(self._summarize(channel_id, memory))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def history(self, channel_id: int) -> List[Dict[str, str]]:
+        """Return a copy of the channel's recent turns, oldest first"""
+        memory = self._channels.get(channel_id)
+        return list(memory.turns) if memory else []
+
+    def summary(self, channel_id: int) -> str:
+        """Return the rolling summary of turns evicted from the channel"""
+        memory = self._channels.get(channel_id)
+        return memory.summary if memory else ""
+
+    def clear(self, channel_id: int) -> bool:
+        """Forget a channel's history and summary, returning whether it had any"""
+        if self.store:
+            self.store.write("DELETE FROM message_history WHERE channel_id = ?", (channel_id,))
+            self.store.write("DELETE FROM history_summaries WHERE channel_id = ?", (channel_id,))
+        return self._channels.pop(channel_id, None) is not None
+
+    async def _summarize(self, channel_id: int, memory: ChannelMemory):
+        """Fold evicted turns into the channel's rolling summary"""
+        try:
+            while memory.evicted:
+                batch, memory.evicted = memory.evicted, []
+                turns_text = "\n".join(f"{turn['role']}: {turn['content']}" for turn in batch)
+                prompt = f"""
+                Update this running summary of a Discord conversation with the new lines below.
+                Keep names, decisions and open questions; drop small talk. Reply with the summary only.
+                Current summary: {memory.summary or 'None yet'}
+                New lines:
+                {turns_text}
+                """
+                model = route_model("summary", memory.guild_id)
+                try:
+                    summary = await generation_tracker.run(
+                        get_ollama_response(prompt, channel_id, PRIORITY_BACKGROUND, model=model),
+                        "summary", channel_id, description="history summary", model=model
+                    )
+                except (GenerationCancelled, asyncio.TimeoutError):
+                    break
+                except SchedulerBusy:
+                    # Try again with the next eviction rather than queueing behind chat
+                    memory.evicted = batch + memory.evicted
+                    break
+                if is_error_response(summary):
+                    continue
+                memory.summary = summary[:self.summary_tokens * 4]
+                if self.store and self._channels.get(channel_id) is memory:
+                    self.store.write(
+                        "INSERT INTO history_summaries (channel_id, guild_id, summary) VALUES (?, ?, ?) "
+                        "ON CONFLICT(channel_id) DO UPDATE SET summary = excluded.summary",
+                        (channel_id, memory.guild_id, memory.summary)
+                    )
+        finally:
+            memory.summarizing = False
 
 # Message history cache
-message_history: Dict[int, List[Dict[str, str]]] = {}
+message_history = ConversationMemory(store=state_store)
+
+class VectorIndex:
+    """Unit-length embeddings for one guild, memory-mapped from disk
+
+    Rows are only ever appended: row i of `<prefix>.vectors` (float32,
+    capacity x dim) goes with row i of `<prefix>.channels` (int64) and the
+    memory_turns row with idx i. `<prefix>.json` records the model,
+    dimension and row count. The files double in size when full, so only
+    pages that are searched or written need to be in RAM, and a search is
+    a single matrix-vector product over the rows in use.
+    """
+
+    INITIAL_CAPACITY = 1024
+    FORGOTTEN = -1  # Channel id given to rows whose channel history was cleared
+
+    def __init__(self, prefix: str, model: str):
+        self.prefix = prefix
+        self.model = model
+        self.dim: Optional[int] = None
+        self.count = 0
+        self.capacity = 0
+        self.vectors = None
+        self.channels = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.prefix + '.json', 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        if meta.get('model') != self.model:
+            # Vectors from another model aren't comparable; start over
+            for suffix in ('.vectors', '.channels', '.json'):
+                if os.path.exists(self.prefix + suffix):
+                    os.remove(self.prefix + suffix)
+            return
+        self.dim = meta['dim']
+        self.count = meta['count']
+        self._map(max(meta.get('capacity', 0), self.count, self.INITIAL_CAPACITY))
+
+    def _map(self, capacity: int):
+        """(Re)open the files memory-mapped with room for `capacity` rows"""
+        for suffix, row_bytes in (('.vectors', self.dim * 4), ('.channels', 8)):
+            path = self.prefix + suffix
+            if not os.path.exists(path) or os.path.getsize(path) < capacity * row_bytes:
+                with open(path, 'ab') as f:
+                    f.truncate(capacity * row_bytes)
+        self.vectors = np.memmap(self.prefix + '.vectors', dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.channels = np.memmap(self.prefix + '.channels', dtype=np.int64, mode='r+', shape=(capacity,))
+        self.capacity = capacity
+
+    def append(self, vectors, channel_ids) -> int:
+        """Add unit-length vectors and their channels, returning the first new row"""
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._map(self.INITIAL_CAPACITY)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"expected {self.dim}-dimensional embeddings, got {vectors.shape[1]}")
+        start, end = self.count, self.count + len(vectors)
+        if end > self.capacity:
+            self.flush()
+            self._map(max(end, self.capacity * 2))
+        self.vectors[start:end] = vectors
+        self.channels[start:end] = channel_ids
+        self.count = end
+        return start
+
+    def search(self, query, k: int, channel_id: Optional[int] = None) -> List[tuple]:
+        """Return up to k (row, score) pairs, best first; runs fine off the event loop"""
+        count = self.count
+        if not count or k <= 0:
+            return []
+        if channel_id is None:
+            rows = None
+            scores = self.vectors[:count] @ query
+            scores[self.channels[:count] == self.FORGOTTEN] = -np.inf
+        else:
+            rows = np.flatnonzero(self.channels[:count] == channel_id)
+            if not len(rows):
+                return []
+            scores = self.vectors[rows] @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i] if rows is not None else i), float(scores[i])) for i in top if scores[i] > -np.inf]
+
+    def forget_channel(self, channel_id: int):
+        """Stop recalling a channel's rows (the space isn't reclaimed)"""
+        if self.count:
+            channels = self.channels[:self.count]
+            channels[channels == channel_id] = self.FORGOTTEN
+
+    def flush(self):
+        """Write mapped pages and the metadata to disk"""
+        if self.vectors is None:
+            return
+        self.vectors.flush()
+        self.channels.flush()
+        meta = {"model": self.model, "dim": self.dim, "count": self.count, "capacity": self.capacity}
+        with open(self.prefix + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.prefix + '.json.tmp', self.prefix + '.json')
+
+class RetrievalMemory:
+    """Long-term recall for busy channels via Ollama embeddings
+
+    Turns are queued as they're added to history and embedded in batches by
+    a background task, then appended to their guild's VectorIndex with the
+    text saved in the state store. When replying, the latest message is
+    embedded and the top_k most similar past turns (above min_score, and
+    not already in the recent history) are added to the prompt, so recall
+    reaches far back while the prompt stays the same size. DMs are never
+    indexed.
+    """
+
+    def __init__(self, store: Optional[StateStore] = None, directory: str = RETRIEVAL_DIR,
+                 model: str = EMBEDDING_MODEL, top_k: int = RETRIEVAL_TOP_K, min_score: float = RETRIEVAL_MIN_SCORE,
+                 scope: str = RETRIEVAL_SCOPE, min_length: int = RETRIEVAL_MIN_LENGTH,
+                 query_timeout: float = RETRIEVAL_QUERY_TIMEOUT, enabled: bool = RETRIEVAL_MEMORY,
+                 batch_size: int = 32, max_pending: int = 1000):
+        if enabled and np is None:
+            print("Retrieval memory needs numpy (pip install numpy); running without it")
+            enabled = False
+        self.enabled = enabled
+        self.store = store
+        self.directory = directory
+        self.model = model
+        self.top_k = top_k
+        self.min_score = min_score
+        self.scope = scope
+        self.min_length = min_length
+        self.query_timeout = query_timeout
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.embedded = 0
+        self.dropped = 0
+        self.recalled = 0
+        self._indexes: Dict[int, VectorIndex] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def index(self, guild_id: int) -> VectorIndex:
+        index = self._indexes.get(guild_id)
+        if index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            index = self._indexes[guild_id] = VectorIndex(os.path.join(self.directory, str(guild_id)), self.model)
+        return index
+
+    def remember(self, guild_id: int, channel_id: int, role: str, content: str):
+        """Queue a turn to be embedded in the background"""
+        if not self.enabled or not guild_id or self._queue is None or len(content) < self.min_length:
+            return
+        try:
+            self._queue.put_nowait((guild_id, channel_id, role, content, time.time()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _embed(self, texts: List[str]):
+        """Embed texts with Ollama, returning unit-length rows or None on failure"""
+        try:
+            data = await inference_client.post_json(
+                '/api/embed', {"model": self.model, "input": texts, "keep_alive": OLLAMA_KEEP_ALIVE}
+            )
+        except (OllamaStatusError, NoBackendAvailable) as e:
+            print(f"Error embedding with {self.model}: {str(e)}")
+            return None
+        vectors = np.asarray(data.get('embeddings') or [], dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(texts):
+            return None
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    async def recall(self, guild_id: int, channel_id: int, text: str,
+                     exclude: Optional[Set[str]] = None) -> List[Dict[str, str]]:
+        """Past turns relevant to text, oldest first; empty if nothing clears the bar"""
+        if not self.enabled or not guild_id or not text:
+            return []
+        index = self.index(guild_id)
+        if not index.count:
+            return []
+        try:
+            vectors = await asyncio.wait_for(self._embed([text]), self.query_timeout)
+        except asyncio.TimeoutError:
+            return []
+        if vectors is None:
+            return []
+        
+        exclude = exclude or set()
+        scope = channel_id if self.scope == "channel" else None
+        hits = await asyncio.get_running_loop().run_in_executor(
+            None, index.search, vectors[0], self.top_k + len(exclude), scope
+        )
+        rows = [row for row, score in hits if score >= self.min_score]
+        if not rows or self.store is None:
+            return []
+        placeholders = ", ".join("?" for _ in rows)
+        found = await self.store.query_async(
+            f"SELECT idx, role, content FROM memory_turns WHERE guild_id = ? AND idx IN ({placeholders})",
+            (guild_id, *rows)
+        )
+        by_row = {idx: (role, content) for idx, role, content in found}
+        picked = [row for row in rows if row in by_row and by_row[row][1] not in exclude][:self.top_k]
+        # Similarity picked them; rows are in the order they were said, which reads better in a prompt
+        turns = [{"role": by_row[row][0], "content": by_row[row][1]} for row in sorted(picked)]
+        self.recalled += len(turns)
+        return turns
+
+    def forget_channel(self, guild_id: int, channel_id: int):
+        """Drop a channel's turns from recall (used by ?clearhistory)"""
+        if not self.enabled or not guild_id:
+            return
+        self.index(guild_id).forget_channel(channel_id)
+        if self.store:
+            self.store.write("DELETE FROM memory_turns WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id))
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            vectors = await self._embed([turn[3] for turn in batch])
+            if vectors is None:
+                continue
+            
+            by_guild: Dict[int, List[int]] = defaultdict(list)
+            for position, turn in enumerate(batch):
+                by_guild[turn[0]].append(position)
+            for guild_id, positions in by_guild.items():
+                index = self.index(guild_id)
+                try:
+                    start = index.append(vectors[positions], [batch[position][1] for position in positions])
+                except ValueError as e:
+                    print(f"Error indexing turns for guild {guild_id}: {str(e)}")
+                    continue
+                for offset, position in enumerate(positions):
+                    _, channel_id, role, content, created_at = batch[position]
+                    if self.store:
+                        self.store.write(
+                            "INSERT OR REPLACE INTO memory_turns (guild_id, idx, channel_id, role, content, created_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (guild_id, start + offset, channel_id, role, content, created_at)
+                        )
+                index.flush()
+            self.embedded += len(batch)
+
+    def start(self):
+        """Start the background embedder (call once the event loop is running)"""
+        if not self.enabled:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop embedding and write every index to disk"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for index in self._indexes.values():
+            index.flush()
+
+# Long-term memory; the embedder starts in setup_hook
+retrieval_memory = RetrievalMemory(store=state_store)
+
+class MessageScheduler:
+    """Delivers scheduled messages on time from a min-heap keyed on due time
+
+    The background task sleeps until the earliest message is due (or until a
+    sooner one is added), so delivery is on time without polling. Cancelled
+    messages are skipped lazily when they reach the top of the heap, and
+    recurring messages are pushed back with their next due time. Pending
+    messages are saved in the state store so they survive restarts.
+    """
+
+    def __init__(self, store: Optional[StateStore] = None):
+        self.store = store
+        self.items: Dict[int, Dict] = {}
+        self._heap: List[tuple] = []
+        self._next_id = 1
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def load(self):
+        """Load pending messages saved by a previous run"""
+        if self.store is None:
+            return
+        rows = self.store.query(
+            "SELECT id, guild_id, channel_id, author_id, message, due, interval FROM scheduled_messages"
+        )
+        for item_id, guild_id, channel_id, author_id, message, due, interval in rows:
+            self._next_id = max(self._next_id, item_id + 1)
+            if not owns_guild(guild_id):
+                continue  # Another process delivers this one
+            self.items[item_id] = {
+                "id": item_id,
+                "channel_id": channel_id,
+                "guild_id": guild_id,
+                "message": message,
+                "due": due,
+                "interval": interval,
+                "author_id": author_id
+            }
+        self._heap = [(item["due"], item["id"]) for item in self.items.values()]
+        heapq.heapify(self._heap)
+
+    def _allocate_id(self) -> int:
+        item_id = self._next_id
+        if SHARD_IDS and SHARD_COUNT:
+            # Processes own disjoint shards, so ids picked from this process's residue can't collide
+            item_id += (SHARD_IDS[0] - item_id) % SHARD_COUNT
+        self._next_id = item_id + 1
+        return item_id
+
+    def _save_item(self, item: Dict):
+        if self.store:
+            self.store.write(
+                "INSERT INTO scheduled_messages (id, guild_id, channel_id, author_id, message, due, interval) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET due = excluded.due",
+                (item["id"], item["guild_id"] or 0, item["channel_id"], item["author_id"],
+                 item["message"], item["due"], item["interval"])
+            )
+
+    def _delete_item(self, item_id: int):
+        if self.store:
+            self.store.write("DELETE FROM scheduled_messages WHERE id = ?", (item_id,))
+
+    def add(self, channel_id: int, message: str, due: float, author_id: int,
+            guild_id: int = None, interval: float = 0) -> Dict:
+        """Schedule a message for a Unix timestamp, repeating every interval seconds if set"""
+        item = {
+            "id": self._allocate_id(),
+            "channel_id": channel_id,
+            "guild_id": guild_id,
+            "message": message,
+            "due": due,
+            "interval": interval,
+            "author_id": author_id
+        }
+        self.items[item["id"]] = item
+        heapq.heappush(self._heap, (due, item["id"]))
+        self._save_item(item)
+        # Wake the sleeper if this message is now the next one due
+        if self._wakeup and self._heap[0][1] == item["id"]:
+            self._wakeup.set()
+        return item
+
+    def cancel(self, item_id: int) -> Optional[Dict]:
+        """Cancel a pending message; its heap entry is skipped when it comes up"""
+        item = self.items.pop(item_id, None)
+        if item:
+            self._delete_item(item_id)
+        return item
+
+    def pending(self, guild_id: int = None) -> List[Dict]:
+        """Pending messages ordered by due time, optionally for one guild"""
+        items = [item for item in self.items.values() if guild_id is None or item["guild_id"] == guild_id]
+        return sorted(items, key=lambda item: item["due"])
+
+    def start(self):
+        """Load saved messages and start the delivery task (only once)"""
+        if self._task is None or self._task.done():
+            self.load()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _next_due(self) -> Optional[float]:
+        # Drop cancelled (or rescheduled) entries sitting at the top
+        while self._heap:
+            due, item_id = self._heap[0]
+            item = self.items.get(item_id)
+            if item is not None and item["due"] == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    async def _run(self):
+        while True:
+            due = self._next_due()
+            timeout = None if due is None else max(0.0, due - time.time())
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            await self.deliver_due()
+
+    async def deliver_due(self, now: float = None):
+        """Send every message that is due and reschedule recurring ones"""
+        now = time.time() if now is None else now
+        delivered = []
+        while True:
+            due = self._next_due()
+            if due is None or due > now:
+                break
+            _, item_id = heapq.heappop(self._heap)
+            delivered.append(self.items[item_id])
+            
+        for item in delivered:
+            channel = bot.get_channel(item["channel_id"])
+            if channel:
+                try:
+                    await channel.send(item["message"])
+                except discord.Forbidden:
+                    print(f"Failed to send scheduled message in channel {channel.id}")
+                except discord.HTTPException as e:
+                    print(f"Failed to send scheduled message in channel {channel.id}: {e}")
+                    
+            if item["id"] not in self.items:
+                continue  # Cancelled while we were sending
+            if item["interval"] > 0:
+                # Skip any runs missed while the bot was offline
+                while item["due"] <= now:
+                    item["due"] += item["interval"]
+                heapq.heappush(self._heap, (item["due"], item["id"]))
+                self._save_item(item)
+            else:
+                del self.items[item["id"]]
+                self._delete_item(item["id"])
 
 # Scheduled messages storage
-scheduled_messages: List[Dict] = []
+message_scheduler = MessageScheduler(state_store)
+
+def parse_duration(text: str) -> int:
+    """Parse a duration like '1h', '30m' or '2h30m' into minutes (0 if invalid)"""
+    total_minutes = 0
+    try:
+        if 'h' in text:
+            hours = int(text.split('h')[0])
+            total_minutes += hours * 60
+            text = text.split('h')[1]
+        if 'm' in text:
+            minutes = int(text.split('m')[0])
+            total_minutes += minutes
+    except ValueError:
+        return 0
+    return total_minutes
 
 # DM conversation tracking
 dm_conversations: Dict[int, Dict] = defaultdict(dict)
 
-# Smart response triggers
-custom_triggers: Dict[str, str] = {}
+class TriggerMatcher:
+    """Aho-Corasick automaton that finds smart-response triggers in one pass
+
+    Triggers are added to the trie as they're registered; the failure links
+    are recomputed lazily on the next lookup after a change. When several
+    triggers match, the one registered first wins, the same order the old
+    linear scan over custom_triggers used. With only a handful of triggers a
+    plain substring scan is faster, so that's used below scan_threshold.
+    """
+
+    def __init__(self, word_boundary: bool = TRIGGER_WORD_BOUNDARY, scan_threshold: int = 128):
+        self.word_boundary = word_boundary
+        self.scan_threshold = scan_threshold
+        self._patterns: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._goto: List[Dict[str, int]] = [{}]
+        self._own: List[List[int]] = [[]]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    def __contains__(self, trigger: str) -> bool:
+        return trigger in self._ids
+
+    def add(self, trigger: str):
+        """Register a (lowercase) trigger; re-adding an existing one is a no-op"""
+        if not trigger or trigger in self._ids:
+            return
+        pattern_id = len(self._patterns)
+        self._patterns.append(trigger)
+        self._ids[trigger] = pattern_id
+        
+        node = 0
+        for char in trigger:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._own.append([])
+            node = next_node
+        self._own[node].append(pattern_id)
+        self._dirty = True
+
+    def _build(self):
+        """Recompute failure links and merged outputs breadth-first
+
+        The tables stay sparse: each state keeps only its own trie edges plus
+        one failure link, so memory grows with the number of states rather
+        than states times alphabet. Lookups follow failure links instead.
+        """
+        goto = self._goto
+        fail = [0] * len(goto)
+        out: List[List[int]] = [list(own) for own in self._own]
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                if node:
+                    state = fail[node]
+                    while state and char not in goto[state]:
+                        state = fail[state]
+                    fail[child] = goto[state].get(char, 0)
+                # Sorted so lookups can stop at the first acceptable match
+                out[child] = sorted(out[child] + out[fail[child]])
+                queue.append(child)
+        self._fail = fail
+        self._out = out
+        self._dirty = False
+
+    def _on_boundary(self, text: str, start: int, end: int) -> bool:
+        before = text[start - 1] if start > 0 else " "
+        after = text[end] if end < len(text) else " "
+        return not (before.isalnum() or before == "_") and not (after.isalnum() or after == "_")
+
+    def find(self, text: str) -> Optional[str]:
+        """Return the highest-priority trigger found in (lowercase) text, if any"""
+        if not self._patterns:
+            return None
+        if len(self._patterns) <= self.scan_threshold and not self.word_boundary:
+            for pattern in self._patterns:
+                if pattern in text:
+                    return pattern
+            return None
+        if self._dirty:
+            self._build()
+            
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self._patterns
+        best = None
+        state = 0
+        for index, char in enumerate(text):
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state if next_state is not None else 0
+            if not out[state]:
+                continue
+            for pattern_id in out[state]:
+                if best is not None and pattern_id >= best:
+                    break
+                if self.word_boundary:
+                    pattern = patterns[pattern_id]
+                    if not self._on_boundary(text, index + 1 - len(pattern), index + 1):
+                        continue
+                best = pattern_id
+                break
+            if best == 0:
+                break  # Nothing can outrank the first trigger
+        return patterns[best] if best is not None else None
+
+# Smart response triggers, per guild (guild id -> trigger -> template)
+custom_triggers: Dict[int, Dict[str, str]] = defaultdict(dict)
+trigger_matchers: Dict[int, TriggerMatcher] = defaultdict(TriggerMatcher)
+
+# Triggers whose responses should be freshly generated every time, per guild
+uncached_triggers: Dict[int, Set[str]] = defaultdict(set)
+
+# Allowed channel IDs per guild (empty means all channels are allowed)
+allowed_channels: Dict[int, Set[int]] = defaultdict(set)
 
-# Set to store allowed channel IDs (empty means all channels are allowed)
-allowed_channels: Set[int] = set()
+# Trusted user IDs per guild
+trusted_users: Dict[int, Set[int]] = defaultdict(set)
 
-# Set to store trusted user IDs
-trusted_users: Set[int] = set()
+# Per-guild overrides of the engagement settings (guild id -> setting -> value)
+guild_settings: Dict[int, Dict[str, str]] = defaultdict(dict)
 
-def is_trusted(user_id: int) -> bool:
-    """Check if a user is in the trusted users list"""
-    return user_id in trusted_users
+def load_state():
+    """Fill the in-memory state caches from the state store"""
+    for guild_id, user_id in state_store.query("SELECT guild_id, user_id FROM trusted_users"):
+        trusted_users[guild_id].add(user_id)
+    for guild_id, channel_id in state_store.query("SELECT guild_id, channel_id FROM allowed_channels"):
+        allowed_channels[guild_id].add(channel_id)
+    rows = state_store.query("SELECT guild_id, trigger, template, cacheable FROM smart_responses ORDER BY rowid")
+    for guild_id, trigger, template, cacheable in rows:
+        custom_triggers[guild_id][trigger] = template
+        trigger_matchers[guild_id].add(trigger)
+        if not cacheable:
+            uncached_triggers[guild_id].add(trigger)
+    for user_id, last_message in state_store.query("SELECT user_id, last_message FROM dm_conversations ORDER BY updated_at"):
+        dm_conversations[user_id]["last_message"] = last_message
+    for guild_id, key, value in state_store.query("SELECT guild_id, key, value FROM guild_settings"):
+        guild_settings[guild_id][key] = value
+
+def set_guild_setting(guild_id: int, key: str, value: str):
+    """Override a setting for one guild and save it"""
+    guild_settings[guild_id][key] = value
+    state_store.write(
+        "INSERT INTO guild_settings (guild_id, key, value) VALUES (?, ?, ?) "
+        "ON CONFLICT(guild_id, key) DO UPDATE SET value = excluded.value",
+        (guild_id, key, value)
+    )
+
+def clear_guild_setting(guild_id: int, key: str):
+    """Drop a guild's override so the global setting applies again"""
+    (guild_settings.get(guild_id) or {}).pop(key, None)
+    state_store.write("DELETE FROM guild_settings WHERE guild_id = ? AND key = ?", (guild_id, key))
+
+def set_trusted(guild_id: int, user_id: int, trusted: bool):
+    """Add or remove a trusted user and save the change"""
+    if trusted:
+        trusted_users[guild_id].add(user_id)
+        state_store.write("INSERT OR IGNORE INTO trusted_users (guild_id, user_id) VALUES (?, ?)", (guild_id, user_id))
+    else:
+        trusted_users[guild_id].discard(user_id)
+        state_store.write("DELETE FROM trusted_users WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+
+def set_channel_allowed(guild_id: int, channel_id: int, allowed: bool):
+    """Allow or disallow a channel and save the change"""
+    if allowed:
+        allowed_channels[guild_id].add(channel_id)
+        state_store.write("INSERT OR IGNORE INTO allowed_channels (guild_id, channel_id) VALUES (?, ?)",
+                          (guild_id, channel_id))
+    else:
+        allowed_channels[guild_id].discard(channel_id)
+        state_store.write("DELETE FROM allowed_channels WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id))
+
+def save_smart_response(guild_id: int, trigger: str, template: str):
+    """Add or update a smart response trigger and save it"""
+    custom_triggers[guild_id][trigger] = template
+    trigger_matchers[guild_id].add(trigger)
+    # Upsert keeps the row (and so the trigger's priority) in place on updates
+    state_store.write(
+        "INSERT INTO smart_responses (guild_id, trigger, template) VALUES (?, ?, ?) "
+        "ON CONFLICT(guild_id, trigger) DO UPDATE SET template = excluded.template",
+        (guild_id, trigger, template)
+    )
+
+def set_trigger_cacheable(guild_id: int, trigger: str, cacheable: bool):
+    """Allow or prevent caching for a trigger's responses and save the setting"""
+    if cacheable:
+        uncached_triggers[guild_id].discard(trigger)
+    else:
+        uncached_triggers[guild_id].add(trigger)
+    state_store.write("UPDATE smart_responses SET cacheable = ? WHERE guild_id = ? AND trigger = ?",
+                      (int(cacheable), guild_id, trigger))
+
+def remember_dm(user_id: int, guild_id: int, message: str):
+    """Track the last message DMed to a user and save it"""
+    dm_conversations[user_id]["last_message"] = message
+    state_store.write(
+        "INSERT INTO dm_conversations (user_id, guild_id, last_message, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(user_id, guild_id) DO UPDATE SET last_message = excluded.last_message, "
+        "updated_at = excluded.updated_at",
+        (user_id, guild_id, message, time.time())
+    )
+
+def is_trusted(user_id: int, guild_id: int) -> bool:
+    """Check if a user is in the guild's trusted users list"""
+    trusted = trusted_users.get(guild_id)
+    return trusted is not None and user_id in trusted
 
 def has_permission(ctx) -> bool:
     """Check if user has permission (admin, owner, or trusted)"""
@@ -93,44 +1523,284 @@ def has_permission(ctx) -> bool:
         return False
     return (ctx.author.guild_permissions.administrator or 
             ctx.guild.owner_id == ctx.author.id or 
-            is_trusted(ctx.author.id))
+            is_trusted(ctx.author.id, ctx.guild.id))
 
-async def permission_check(ctx):
-    """Check if the user has permission, send error if not"""
-    if not has_permission(ctx):
-        await ctx.send("Sorry fam, you need admin perms for that! 🚫")
-        return False
-    return True
+# Engagement levels, from cheapest to most expensive
+ENGAGE_NONE = 0  # Ignore the message entirely
+ENGAGE_TRIGGERS = 1  # Only smart-response triggers may fire
+ENGAGE_CHAT = 2  # Full AI conversation reply
 
-async def log_action(guild: discord.Guild, action_type: str, action: str, user: str, target: str = None, details: str = None):
-    """Log actions to the designated logging channel"""
-    if not LOGS_CHANNEL_ID:
-        return
+# How many messages stopped at each engagement level
+engagement_counts: Dict[int, int] = defaultdict(int)
+
+def engagement_level(message: discord.Message) -> int:
+    """Decide how much work a message deserves using only cheap lookups
+
+    Runs before any prompt building or inference: disabled guilds and
+    channels outside the allow list are ignored, and messages that don't
+    meet the guild's mode or minimum length can only fire triggers.
+    """
+    if message.guild is None:
+        return ENGAGE_CHAT  # DMs are always a conversation with the bot
         
-    log_channel = guild.get_channel(LOGS_CHANNEL_ID)
-    if not log_channel:
-        return
+    settings = guild_settings.get(message.guild.id) or {}
+    if settings.get("enabled", "on") == "off":
+        return ENGAGE_NONE
+    channels = allowed_channels.get(message.guild.id)
+    if channels and message.channel.id not in channels:
+        return ENGAGE_NONE
         
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Emoji mapping for different action types
-    type_emojis = {
-        "admin": "🛡️",
-        "mod": "🔨",
-        "dm": "📨",
-        "chat": "💬",
-        "system": "⚙️"
-    }
-    
-    emoji = type_emojis.get(action_type, "ℹ️")
-    log_message = f"{emoji} **{action}** • {timestamp}\n👤 **User:** {user}"
-    
-    if target:
-        log_message += f"\n🎯 **Target:** {target}"
-    if details:
+    if len(message.content.strip()) < int(settings.get("min_length", ENGAGEMENT_MIN_LENGTH)):
+        return ENGAGE_TRIGGERS
+        
+    mode = settings.get("mode", ENGAGEMENT_MODE)
+    if mode == "all":
+        return ENGAGE_CHAT
+    reference = message.reference
+    replied_to_bot = (reference is not None and isinstance(reference.resolved, discord.Message)
+                      and reference.resolved.author.id == bot.user.id)
+    if replied_to_bot or (mode == "mention" and bot.user in message.mentions):
+        return ENGAGE_CHAT
+    return ENGAGE_TRIGGERS
+
+class TokenBucketLimiter:
+    """Token buckets for one scope (users, channels or guilds)
+
+    Each key gets `burst` tokens that refill at per_minute tokens a minute.
+    Buckets live in LRU order; ones that have been idle long enough to be
+    full again are indistinguishable from new ones and are dropped, and
+    the total is capped at max_buckets.
+    """
+
+    def __init__(self, per_minute: float, burst: int, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.throttled = 0
+        self._buckets: OrderedDict = OrderedDict()  # key -> [tokens, last refill time]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _expire(self, now: float):
+        refill_time = self.burst / self.rate if self.rate > 0 else float("inf")
+        while self._buckets:
+            key, (_, last) = next(iter(self._buckets.items()))
+            if now - last < refill_time and len(self._buckets) <= self.max_buckets:
+                break
+            self._buckets.popitem(last=False)
+
+    def available(self, key, now: float) -> float:
+        """Tokens the key's bucket holds right now"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(self.burst)
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def consume(self, key, now: float):
+        """Take one token from the key's bucket"""
+        tokens = self.available(key, now) - 1
+        self._buckets[key] = [tokens, now]
+        self._buckets.move_to_end(key)
+        self._expire(now)
+
+class RateLimiter:
+    """Per-user, per-channel and per-guild token-bucket limits on AI replies"""
+
+    def __init__(self):
+        self.scopes = {
+            "user": TokenBucketLimiter(RATE_LIMIT_USER_PER_MINUTE, RATE_LIMIT_USER_BURST),
+            "channel": TokenBucketLimiter(RATE_LIMIT_CHANNEL_PER_MINUTE, RATE_LIMIT_CHANNEL_BURST),
+            "guild": TokenBucketLimiter(RATE_LIMIT_GUILD_PER_MINUTE, RATE_LIMIT_GUILD_BURST)
+        }
+
+    def check(self, user_id: int, channel_id: int, guild_id: Optional[int]) -> Optional[str]:
+        """Consume a token from every applicable bucket, or return the scope that's out"""
+        now = time.monotonic()
+        keys = {"user": user_id, "channel": channel_id}
+        if guild_id is not None:
+            keys["guild"] = guild_id
+        # Only spend tokens if every bucket can afford it
+        for scope, key in keys.items():
+            limiter = self.scopes[scope]
+            if limiter.available(key, now) < 1:
+                limiter.throttled += 1
+                return scope
+        for scope, key in keys.items():
+            self.scopes[scope].consume(key, now)
+        return None
+
+    def throttled_counts(self) -> Dict[str, int]:
+        return {scope: limiter.throttled for scope, limiter in self.scopes.items()}
+
+# Shared limiter for AI replies
+rate_limiter = RateLimiter()
+
+def is_rate_limit_exempt(message: discord.Message) -> bool:
+    """Admins, the owner and trusted users aren't rate limited"""
+    if message.guild is None or not isinstance(message.author, discord.Member):
+        return False
+    return (message.author.guild_permissions.administrator or
+            message.guild.owner_id == message.author.id or
+            is_trusted(message.author.id, message.guild.id))
+
+async def rate_limited(message: discord.Message) -> bool:
+    """Charge a message against the rate limits, reacting with ⏳ if it's over them"""
+    if is_rate_limit_exempt(message):
+        return False
+    if rate_limiter.check(message.author.id, message.channel.id, message.guild.id if message.guild else None):
+        try:
+            await message.add_reaction("⏳")
+        except discord.HTTPException:
+            pass
+        return True
+    return False
+
+async def permission_check(ctx):
+    """Check if the user has permission, send error if not"""
+    if not has_permission(ctx):
+        await ctx.send("Sorry fam, you need admin perms for that! 🚫")
+        return False
+    return True
+
+# Emoji mapping for different action types
+LOG_TYPE_EMOJIS = {
+    "admin": "🛡️",
+    "mod": "🔨",
+    "dm": "📨",
+    "chat": "💬",
+    "system": "⚙️"
+}
+
+def format_log_entry(action_type: str, action: str, user: str, target: str = None, details: str = None) -> str:
+    """Format one audit log entry the way it appears in the log channel"""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    emoji = LOG_TYPE_EMOJIS.get(action_type, "ℹ️")
+    log_message = f"{emoji} **{action}** • {timestamp}\n👤 **User:** {user}"
+    
+    if target:
+        log_message += f"\n🎯 **Target:** {target}"
+    if details:
         log_message += f"\n📝 **Details:** {details}"
         
-    await log_channel.send(log_message)
+    return log_message[:DISCORD_MESSAGE_LIMIT]
+
+class AuditLogger:
+    """Background writer that batches audit log entries per log channel
+
+    Entries are buffered per guild and written by a single task every
+    flush_interval seconds (or sooner once a guild has a full batch), several
+    entries to a message. Low-value chat entries are sampled once the backlog
+    grows and everything is dropped past max_pending, so logging never
+    holds up replies.
+    """
+
+    def __init__(self, flush_interval: float = LOG_FLUSH_INTERVAL, batch_size: int = LOG_BATCH_SIZE,
+                 max_pending: int = LOG_QUEUE_MAX, pressure_threshold: int = LOG_PRESSURE_THRESHOLD,
+                 chat_sample_rate: float = LOG_CHAT_SAMPLE_RATE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pressure_threshold = pressure_threshold
+        self.chat_sample_rate = chat_sample_rate
+        self.pending = 0
+        self.dropped = 0
+        self.batches_sent = 0
+        self._buffers: Dict[int, List[str]] = defaultdict(list)
+        self._channels: Dict[int, Optional[discord.abc.Messageable]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def resolve_channel(self, guild: discord.Guild):
+        """Return the guild's log channel, caching the lookup once it's found"""
+        channel = self._channels.get(guild.id)
+        if channel is None:
+            # Misses aren't cached: the guild may still be unavailable or the channel not created yet
+            channel = guild.get_channel(LOGS_CHANNEL_ID)
+            if channel is not None:
+                self._channels[guild.id] = channel
+        return channel
+
+    def enqueue(self, guild: discord.Guild, action_type: str, entry: str) -> bool:
+        """Queue an entry for the guild's log channel; returns False if it was dropped"""
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            return False
+        if (action_type == "chat" and self.pending >= self.pressure_threshold
+                and random.random() >= self.chat_sample_rate):
+            self.dropped += 1
+            return False
+        if not self.resolve_channel(guild):
+            return False
+            
+        buffer = self._buffers[guild.id]
+        buffer.append(entry)
+        self.pending += 1
+        if len(buffer) >= self.batch_size and self._wakeup:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        """Start the background writer"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """Stop the writer and flush whatever is still queued"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write every buffered entry, several entries per message"""
+        for guild_id in list(self._buffers):
+            entries = self._buffers.pop(guild_id)
+            self.pending -= len(entries)
+            channel = self._channels.get(guild_id)
+            if not channel:
+                continue
+                
+            batch = []
+            for entry in entries + [None]:
+                if batch and (entry is None or len(batch) >= self.batch_size or
+                              len("\n\n".join(batch + [entry])) > DISCORD_MESSAGE_LIMIT):
+                    try:
+                        await channel.send("\n\n".join(batch))
+                        self.batches_sent += 1
+                    except (discord.NotFound, discord.Forbidden):
+                        # Channel went away or we lost access; look it up again next time
+                        self._channels.pop(guild_id, None)
+                        break
+                    except discord.HTTPException as e:
+                        print(f"Failed to write audit log batch: {e}")
+                    batch = []
+                if entry is not None:
+                    batch.append(entry)
+
+# Shared audit log writer, started in setup_hook and flushed when the bot shuts down
+audit_log = AuditLogger()
+
+async def log_action(guild: discord.Guild, action_type: str, action: str, user: str, target: str = None, details: str = None):
+    """Log actions to the designated logging channel (queued, never waits on Discord)"""
+    if not LOGS_CHANNEL_ID or guild is None:
+        return
+        
+    audit_log.enqueue(guild, action_type, format_log_entry(action_type, action, user, target, details))
 
 async def log_admin_action(guild: discord.Guild, action: str, mod: str, target: str, reason: str = None):
     """Legacy admin action logging - redirects to new log_action function"""
@@ -150,166 +1820,1930 @@ def clean_response(response: str) -> str:
     
     return response
 
-async def get_ollama_response(prompt: str) -> str:
+class ThinkFilter:
+    """Incremental version of clean_response for streamed text
+
+    Feed it chunks as they arrive and it returns only the visible part,
+    holding back anything inside a <think>...</think> section (even while
+    that section is still being streamed) and any partially received tag.
     """
-    Send a prompt to Ollama API and get the response
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._pending = ""
+        self._in_think = False
+        self._started = False
+
+    @staticmethod
+    def _partial_tag_length(text: str, tag: str) -> int:
+        """Length of the longest suffix of text that could be the start of tag"""
+        lower = text.lower()
+        for size in range(min(len(tag) - 1, len(lower)), 0, -1):
+            if tag.startswith(lower[-size:]):
+                return size
+        return 0
+
+    def feed(self, chunk: str) -> str:
+        """Consume a streamed chunk and return the text that is safe to show"""
+        self._pending += chunk
+        visible = ""
+        while self._pending:
+            lower = self._pending.lower()
+            if self._in_think:
+                end = lower.find(self.CLOSE_TAG)
+                if end == -1:
+                    keep = self._partial_tag_length(self._pending, self.CLOSE_TAG)
+                    self._pending = self._pending[len(self._pending) - keep:] if keep else ""
+                    break
+                self._pending = self._pending[end + len(self.CLOSE_TAG):]
+                self._in_think = False
+                continue
+            start = lower.find(self.OPEN_TAG)
+            if start != -1:
+                visible += self._pending[:start]
+                self._pending = self._pending[start + len(self.OPEN_TAG):]
+                self._in_think = True
+                continue
+            keep = self._partial_tag_length(self._pending, self.OPEN_TAG)
+            cut = len(self._pending) - keep
+            visible += self._pending[:cut]
+            self._pending = self._pending[cut:]
+            break
+        return self._clean(visible)
+
+    def flush(self) -> str:
+        """Return whatever is still held back once the stream has ended"""
+        if self._in_think:
+            self._pending = ""
+            return ""
+        rest, self._pending = self._pending, ""
+        return self._clean(rest)
+
+    def _clean(self, text: str) -> str:
+        # Same tag stripping as clean_response, plus dropping leading whitespace
+        text = text.replace("<", "").replace(">", "")
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+class OllamaStatusError(Exception):
+    """Raised when Ollama answers a request with a non-200 status"""
+
+    def __init__(self, status: int):
+        super().__init__(f"Received status code {status}")
+        self.status = status
+
+class OllamaClient:
+    """Long-lived Ollama HTTP client sharing one keep-alive connection pool"""
+
+    def __init__(self, max_connections: int = OLLAMA_MAX_CONNECTIONS,
+                 max_connections_per_host: int = OLLAMA_MAX_CONNECTIONS_PER_HOST,
+                 keepalive_timeout: float = OLLAMA_KEEPALIVE_TIMEOUT,
+                 connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+                 request_timeout: float = OLLAMA_REQUEST_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout, connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> aiohttp.ClientSession:
+        """Create the pooled session if it doesn't exist yet"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        """Close the session and every pooled connection"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _timeout_option(self, timeout: Optional[float]) -> Dict:
+        # Passing timeout=None would switch off the session's timeouts, so leave it out unless overriding
+        if not timeout:
+            return {}
+        return {"timeout": aiohttp.ClientTimeout(total=timeout, connect=self.timeout.connect)}
+
+    async def post_json(self, url: str, payload: Dict, timeout: Optional[float] = None) -> tuple:
+        """POST a JSON payload and return (status, decoded JSON or None)"""
+        session = await self.start()
+        async with session.post(url, json=payload, **self._timeout_option(timeout)) as response:
+            if response.status != 200:
+                return response.status, None
+            try:
+                return response.status, await response.json()
+            except asyncio.CancelledError:
+                # Drop the connection so Ollama stops generating for us
+                response.close()
+                raise
+
+    async def get_json(self, url: str, timeout: Optional[float] = None) -> tuple:
+        """GET a URL and return (status, decoded JSON or None)"""
+        session = await self.start()
+        async with session.get(url, **self._timeout_option(timeout)) as response:
+            if response.status != 200:
+                return response.status, None
+            return response.status, await response.json()
+
+    async def stream_json(self, url: str, payload: Dict):
+        """POST a streaming request and yield each decoded NDJSON object"""
+        session = await self.start()
+        async with session.post(url, json=payload) as response:
+            if response.status != 200:
+                raise OllamaStatusError(response.status)
+            try:
+                async for line in response.content:
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line)
+            except (asyncio.CancelledError, GeneratorExit):
+                # Drop the connection so Ollama stops generating for us
+                response.close()
+                raise
+
+# Shared Ollama client, opened in setup_hook and closed when the bot shuts down
+ollama_client = OllamaClient()
+
+def ollama_base_url(url: str) -> str:
+    """Strip an endpoint path from an Ollama URL, leaving scheme, host and port"""
+    url = url.strip().rstrip('/')
+    for suffix in ('/api/generate', '/api/chat', '/api'):
+        if url.endswith(suffix):
+            return url[:-len(suffix)]
+    return url
+
+def normalize_model_name(name: str) -> str:
+    """Give a model name Ollama's implicit :latest tag so names compare equal"""
+    return name if ':' in name else f"{name}:latest"
+
+class NoBackendAvailable(Exception):
+    """Raised when every Ollama backend is ejected or failed the request"""
+
+class OllamaBackend:
+    """One Ollama host: its load, the models it has, and its circuit breaker
+
+    After `failure_threshold` failures in a row the host is ejected for
+    `eject_seconds`. Once that passes it is let back in on probation: a
+    success closes the breaker, another failure ejects it again.
+    """
+
+    def __init__(self, base_url: str, failure_threshold: int = OLLAMA_FAILURE_THRESHOLD,
+                 eject_seconds: float = OLLAMA_EJECT_SECONDS):
+        self.base_url = base_url
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.models: Set[str] = set()  # Installed models, from /api/tags
+        self.loaded: Set[str] = set()  # Models in memory, from /api/ps
+        self.probed = False
+        self.requests = 0
+        self.errors = 0
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """Whether the breaker lets requests through"""
+        return (now if now is not None else time.monotonic()) >= self.ejected_until
+
+    def model_rank(self, model: str) -> int:
+        """0 if the model is loaded, 1 if installed, 2 if unknown (not probed yet), 3 if missing"""
+        if model in self.loaded:
+            return 0
+        if model in self.models:
+            return 1
+        return 3 if self.probed else 2
+
+    def record_success(self):
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def record_failure(self):
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.ejected_until = time.monotonic() + self.eject_seconds
+
+    def state(self) -> str:
+        if not self.available():
+            return "ejected"
+        if self.failures:
+            return "degraded"
+        return "healthy"
+
+class OllamaPool:
+    """Routes Ollama requests across one or more backends
+
+    Each request goes to an available host that has the model, preferring
+    hosts that already have it loaded, then the one with the fewest
+    requests in flight. Connection errors, timeouts and 5xx responses
+    count against a host's breaker and the request is retried on the next
+    candidate; streams are only retried if nothing was yielded yet. A
+    background task probes /api/tags and /api/ps to keep model lists and
+    breaker state fresh.
+    """
+
+    def __init__(self, urls: List[str] = OLLAMA_API_URLS, client: Optional[OllamaClient] = None,
+                 health_interval: float = OLLAMA_HEALTH_INTERVAL, health_timeout: float = OLLAMA_HEALTH_TIMEOUT):
+        base_urls = list(dict.fromkeys(ollama_base_url(url) for url in urls))
+        self.backends = [OllamaBackend(url) for url in base_urls]
+        self.client = client or ollama_client
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._health_task: Optional[asyncio.Task] = None
+        self._turn = 0  # Rotates ties so equally idle hosts share the load
+
+    def candidates(self, model: str) -> List[OllamaBackend]:
+        """Available backends for a model, best first"""
+        model = normalize_model_name(model)
+        now = time.monotonic()
+        ranks = {backend: backend.model_rank(model) for backend in self.backends if backend.available(now)}
+        if any(rank < 2 for rank in ranks.values()):
+            # Skip hosts known to be missing the model
+            candidates = [backend for backend, rank in ranks.items() if rank < 3]
+        else:
+            # Nobody reports the model; let a host answer (and explain) rather than failing silently
+            candidates = list(ranks)
+        self._turn = (self._turn + 1) % max(len(self.backends), 1)
+        order = {backend: (i - self._turn) % len(self.backends) for i, backend in enumerate(self.backends)}
+        candidates.sort(key=lambda backend: (ranks[backend], backend.outstanding, order[backend]))
+        return candidates
+
+    async def post_json(self, path: str, payload: Dict) -> Dict:
+        """Send a non-streaming request, failing over between backends
+
+        Raises OllamaStatusError for client errors (e.g. unknown model) and
+        NoBackendAvailable once every candidate has failed.
+        """
+        last_error = None
+        for backend in self.candidates(payload.get('model', MODEL_NAME)):
+            backend.outstanding += 1
+            backend.requests += 1
+            try:
+                status, data = await self.client.post_json(backend.url(path), payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                backend.record_failure()
+                last_error = e
+                continue
+            finally:
+                backend.outstanding -= 1
+            if status >= 500:
+                backend.record_failure()
+                last_error = OllamaStatusError(status)
+                continue
+            backend.record_success()
+            if status != 200:
+                raise OllamaStatusError(status)
+            return data
+        raise NoBackendAvailable(str(last_error) if last_error else "every Ollama backend is ejected")
+
+    async def stream_json(self, path: str, payload: Dict):
+        """Stream a request, failing over to the next backend until data arrives"""
+        last_error = None
+        for backend in self.candidates(payload.get('model', MODEL_NAME)):
+            backend.outstanding += 1
+            backend.requests += 1
+            started = False
+            stream = self.client.stream_json(backend.url(path), payload)
+            try:
+                async for data in stream:
+                    started = True
+                    yield data
+                backend.record_success()
+                return
+            except OllamaStatusError as e:
+                if e.status < 500:
+                    backend.record_success()
+                    raise
+                backend.record_failure()
+                last_error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                backend.record_failure()
+                if started:
+                    raise
+                last_error = e
+            finally:
+                backend.outstanding -= 1
+                await stream.aclose()
+        raise NoBackendAvailable(str(last_error) if last_error else "every Ollama backend is ejected")
+
+    async def probe(self, backend: OllamaBackend):
+        """Refresh a backend's model lists; a failed probe counts against its breaker"""
+        try:
+            status, tags = await self.client.get_json(backend.url('/api/tags'), self.health_timeout)
+            if status != 200 or tags is None:
+                raise OllamaStatusError(status)
+            status, ps = await self.client.get_json(backend.url('/api/ps'), self.health_timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OllamaStatusError, ValueError):
+            backend.record_failure()
+            return
+        backend.models = {normalize_model_name(model.get('name', '')) for model in tags.get('models', [])}
+        # Older Ollama versions have no /api/ps; leave "loaded" empty rather than failing the probe
+        backend.loaded = ({normalize_model_name(model.get('name', '')) for model in ps.get('models', [])}
+                          if status == 200 and ps else set())
+        backend.probed = True
+        backend.record_success()
+
+    async def probe_all(self):
+        await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                print(f"Error probing Ollama backends: {str(e)}")
+            await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        """Start probing backends in the background (call once the event loop is running)"""
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+# Shared backend pool; health probes start in setup_hook
+ollama_pool = OllamaPool()
+
+class ModelWarmer:
+    """Loads models onto the Ollama backends ahead of the first real request
+
+    A request with a model but no prompt makes Ollama load the model and
+    return, so the 10-30 second cold load happens here in the background
+    instead of inside someone's reply. With keep_warm on, a loop reloads the
+    current model on any healthy host whose /api/ps no longer lists it.
+    """
+
+    def __init__(self, pool: OllamaPool, keep_alive=OLLAMA_KEEP_ALIVE, keep_warm: bool = OLLAMA_KEEP_WARM,
+                 interval: float = OLLAMA_HEALTH_INTERVAL):
+        self.pool = pool
+        self.keep_alive = keep_alive
+        self.keep_warm = keep_warm
+        self.interval = interval
+        # (backend url, model) -> {"state": warming/warm/failed/unloaded, "seconds": last load time}
+        self.status: Dict[tuple, Dict] = {}
+        self._loads: Dict[tuple, asyncio.Task] = {}
+        self._keep_warm_task: Optional[asyncio.Task] = None
+
+    async def _load(self, backend: OllamaBackend, model: str):
+        key = (backend.base_url, normalize_model_name(model))
+        self.status[key] = {"state": "warming", "seconds": None}
+        started = time.monotonic()
+        try:
+            status, _ = await self.pool.client.post_json(
+                backend.url('/api/generate'), {"model": model, "stream": False, "keep_alive": self.keep_alive}
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error warming up {model} on {backend.base_url}: {str(e)}")
+            self.status[key] = {"state": "failed", "seconds": None}
+            return
+        if status != 200:
+            print(f"Error warming up {model} on {backend.base_url}: status code {status}")
+            self.status[key] = {"state": "failed", "seconds": None}
+            return
+        backend.loaded.add(key[1])
+        self.status[key] = {"state": "warm", "seconds": time.monotonic() - started}
+
+    def warm(self, model: str, backends: Optional[List[OllamaBackend]] = None) -> int:
+        """Start loading a model in the background; returns how many hosts were asked
+
+        Hosts that are ejected, known to lack the model, or already loading
+        it are skipped.
+        """
+        model_key = normalize_model_name(model)
+        started = 0
+        for backend in backends if backends is not None else self.pool.backends:
+            key = (backend.base_url, model_key)
+            if not backend.available() or backend.model_rank(model_key) == 3:
+                continue
+            if key in self._loads and not self._loads[key].done():
+                continue
+            self._loads[key] = asyncio.create_task(self._load(backend, model))
+            started += 1
+        return started
+
+    async def unload(self, model: str):
+        """Ask every host to drop a model from memory right away"""
+        model_key = normalize_model_name(model)
+        for key, task in list(self._loads.items()):
+            if key[1] == model_key and not task.done():
+                task.cancel()
+
+        async def unload_from(backend: OllamaBackend):
+            try:
+                await self.pool.client.post_json(
+                    backend.url('/api/generate'), {"model": model, "stream": False, "keep_alive": 0}
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Error unloading {model} from {backend.base_url}: {str(e)}")
+                return
+            backend.loaded.discard(model_key)
+            self.status[(backend.base_url, model_key)] = {"state": "unloaded", "seconds": None}
+
+        await asyncio.gather(*(unload_from(backend) for backend in self.pool.backends if backend.available()))
+
+    async def _keep_warm_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for name in filter(None, (MODEL_NAME, OLLAMA_LIGHT_MODEL)):
+                model = normalize_model_name(name)
+                # Relies on the pool's health probes to keep backend.loaded current
+                self.warm(name, [backend for backend in self.pool.backends
+                                 if backend.probed and model not in backend.loaded])
+
+    def start(self):
+        """Start the keep-warm loop if enabled (call once the event loop is running)"""
+        if self.keep_warm and (self._keep_warm_task is None or self._keep_warm_task.done()):
+            self._keep_warm_task = asyncio.create_task(self._keep_warm_loop())
+
+    async def close(self):
+        tasks = [task for task in self._loads.values() if not task.done()]
+        if self._keep_warm_task:
+            tasks.append(self._keep_warm_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loads.clear()
+        self._keep_warm_task = None
+
+# Shared model warmer; the keep-warm loop starts in setup_hook
+model_warmer = ModelWarmer(ollama_pool)
+
+class InferenceWorker:
+    """Serves Ollama requests from gateway processes over a Unix socket
+
+    The protocol is JSON lines. A gateway sends
+    {"id", "op": "post" | "stream" | "cancel", "path", "payload"}; the worker
+    answers with {"id", "data"} lines and a final {"id", "done": true}, or
+    a single {"id", "error": "status" | "unavailable" | "connection" | "internal", ...}.
+    Requests run concurrently through this process's own backend pool, and
+    a cancel (or the gateway hanging up) cancels the Ollama request too.
+    """
+
+    def __init__(self, path: str, pool: OllamaPool):
+        self.path = path
+        self.pool = pool
+        self.served = 0
+
+    async def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # Left over from a worker that didn't shut down cleanly
+        server = await asyncio.start_unix_server(self._handle, self.path, limit=INFERENCE_WORKER_MESSAGE_LIMIT)
+        print(f"Inference worker listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks: Dict[int, asyncio.Task] = {}
+        write_lock = asyncio.Lock()
+
+        async def send(message: Dict):
+            async with write_lock:
+                writer.write((json.dumps(message) + "\n").encode())
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message["op"] == "cancel":
+                    task = tasks.pop(message["id"], None)
+                    if task:
+                        task.cancel()
+                    continue
+                task = asyncio.create_task(self._serve(message, send))
+                tasks[message["id"]] = task
+                task.add_done_callback(lambda _, request_id=message["id"]: tasks.pop(request_id, None))
+        except (ConnectionError, ValueError) as e:
+            print(f"Inference worker dropped a gateway connection: {str(e)}")
+        finally:
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    async def _serve(self, message: Dict, send):
+        request_id = message["id"]
+        try:
+            if message["op"] == "stream":
+                async for data in self.pool.stream_json(message["path"], message["payload"]):
+                    await send({"id": request_id, "data": data})
+                await send({"id": request_id, "done": True})
+            else:
+                data = await self.pool.post_json(message["path"], message["payload"])
+                await send({"id": request_id, "data": data, "done": True})
+            self.served += 1
+        except OllamaStatusError as e:
+            await send({"id": request_id, "error": "status", "status": e.status})
+        except NoBackendAvailable as e:
+            await send({"id": request_id, "error": "unavailable", "message": str(e)})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await send({"id": request_id, "error": "connection", "message": str(e) or type(e).__name__})
+        except ConnectionError:
+            pass  # The gateway went away; nobody is listening for the result
+        except Exception as e:
+            # Anything else (a malformed request, an unreadable Ollama body) still has to
+            # answer, or the gateway waits on this request forever
+            print(f"Inference worker failed request {request_id}: {type(e).__name__}: {str(e)}")
+            try:
+                await send({"id": request_id, "error": "internal", "message": f"{type(e).__name__}: {str(e)}"})
+            except ConnectionError:
+                pass
+
+class WorkerConnection:
+    """A gateway's connection to one inference worker, multiplexing requests by id"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.outstanding = 0
+        self.pending: Dict[int, asyncio.Queue] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._retry_at = 0.0
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self) -> bool:
+        """Connect if needed, backing off for a few seconds after a failure"""
+        if self.connected:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.connected:
+                return True
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(
+                    self.path, limit=INFERENCE_WORKER_MESSAGE_LIMIT
+                )
+            except OSError as e:
+                print(f"Can't reach inference worker {self.path}: {str(e)}")
+                self._retry_at = time.monotonic() + 5
+                return False
+            self._reader_task = asyncio.create_task(self._read(reader))
+            return True
+
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                queue = self.pending.get(message["id"])
+                if queue is not None:
+                    queue.put_nowait(message)
+        except (ConnectionError, ValueError) as e:
+            print(f"Lost inference worker {self.path}: {str(e)}")
+        finally:
+            if self._writer:
+                self._writer.close()
+            self._writer = None
+            for queue in self.pending.values():
+                queue.put_nowait({"error": "worker_lost"})
+
+    def send(self, message: Dict):
+        # Writes are buffered by the transport; requests are small enough not to need drain()
+        self._writer.write((json.dumps(message) + "\n").encode())
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+        if self._reader_task:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+
+class WorkerClient:
+    """Sends Ollama requests to inference worker processes instead of Ollama
+
+    Offers the same post_json/stream_json calls as OllamaPool. Requests go
+    to the connected worker with the fewest in flight. If a worker dies
+    before answering, the request moves on to the next one (streams only
+    before the first chunk). Once no worker is reachable, NoBackendAvailable
+    is raised like it is for an empty pool.
+    """
+
+    def __init__(self, paths: List[str]):
+        self.workers = [WorkerConnection(path) for path in paths]
+        self._next_id = 0
+
+    async def _request(self, op: str, path: str, payload: Dict):
+        candidates = sorted(self.workers, key=lambda worker: worker.outstanding)
+        for worker in candidates:
+            if not await worker.connect():
+                continue
+            self._next_id += 1
+            request_id = self._next_id
+            queue = worker.pending[request_id] = asyncio.Queue()
+            worker.outstanding += 1
+            started = finished = False
+            try:
+                worker.send({"id": request_id, "op": op, "path": path, "payload": payload})
+                while True:
+                    message = await queue.get()
+                    error = message.get("error")
+                    if error == "worker_lost" and not started:
+                        break  # Try the next worker
+                    if error == "status":
+                        raise OllamaStatusError(message["status"])
+                    if error == "unavailable":
+                        raise NoBackendAvailable(message["message"])
+                    if error:
+                        raise aiohttp.ClientConnectionError(message.get("message", "inference worker lost"))
+                    finished = message.get("done", False)
+                    if "data" in message:
+                        started = True
+                        yield message["data"]
+                    if finished:
+                        return
+            finally:
+                worker.pending.pop(request_id, None)
+                worker.outstanding -= 1
+                if not finished and worker.connected:
+                    # Stop the generation on the worker too
+                    worker.send({"id": request_id, "op": "cancel"})
+        raise NoBackendAvailable("no inference worker is reachable")
+
+    async def post_json(self, path: str, payload: Dict) -> Dict:
+        requests = self._request("post", path, payload)
+        try:
+            async for data in requests:
+                return data
+        finally:
+            await requests.aclose()
+        raise NoBackendAvailable("inference worker sent no response")
+
+    async def stream_json(self, path: str, payload: Dict):
+        requests = self._request("stream", path, payload)
+        try:
+            async for data in requests:
+                yield data
+        finally:
+            await requests.aclose()
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.close()
+
+# Where generations go: to inference worker processes if configured, otherwise straight to the backend pool
+inference_client = WorkerClient(INFERENCE_WORKER_SOCKETS) if INFERENCE_WORKER_SOCKETS else ollama_pool
+
+class ResponseCache:
+    """Size-bounded LRU cache of Ollama responses with a per-entry TTL
+
+    Keys are the model name plus the prompt with case and whitespace
+    normalized, so trivially different prompts share an entry.
+    """
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE_ENABLED, max_size: int = RESPONSE_CACHE_SIZE,
+                 ttl: float = RESPONSE_CACHE_TTL):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """Lowercase a prompt and collapse its whitespace"""
+        return " ".join(prompt.lower().split())
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        """Return a fresh cached response, or None on a miss"""
+        key = (model, self.normalize(prompt))
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, model: str, prompt: str, response: str):
+        """Store a response, evicting the least recently used entries if full"""
+        key = (model, self.normalize(prompt))
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, model: str = None):
+        """Drop every entry, or only those generated by one model"""
+        if model is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == model]:
+            del self._entries[key]
+
+# Shared cache for repeated smart-response prompts
+response_cache = ResponseCache()
+
+class SingleFlight:
+    """Runs identical concurrent requests once and gives every caller the result
+
+    The first caller for a key starts the request as its own task; callers
+    that arrive while it's running wait on that task instead of starting
+    another generation. A caller that is cancelled only stops waiting: the
+    request itself is cancelled once nobody is waiting for it any more.
+    """
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self.started = 0  # Requests actually sent
+        self.shared = 0  # Callers served by a request someone else started
+        self._flights: Dict[tuple, list] = {}  # key -> [task, callers waiting]
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(self, key: tuple, factory):
+        """Await factory() for this key, or join the call already in flight"""
+        if not self.enabled:
+            return await factory()
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = [asyncio.create_task(factory()), 0]
+            self._flights[key] = flight
+            flight[0].add_done_callback(lambda _: self._forget(key, flight))
+            self.started += 1
+        else:
+            self.shared += 1
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not flight[0].done():
+                flight[0].cancel()
+
+    def _forget(self, key: tuple, flight: list):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+# Shared dedup layer for one-off prompts (DMs, summaries) and smart-response replies to the same message
+single_flight = SingleFlight()
+
+def is_error_response(response: str) -> bool:
+    """Whether a response is an error or fallback notice rather than generated text"""
+    return response.startswith("Error") or response in (FRIENDLY_ERRORS["busy"], FRIENDLY_ERRORS["ollama_down"])
+
+def is_cacheable_response(response: str) -> bool:
+    """Whether a response is worth caching (not an error or busy notice)"""
+    return bool(response) and not is_error_response(response)
+
+# Inference priorities, lower runs first
+PRIORITY_INTERACTIVE = 0  # Replies to people chatting with the bot
+PRIORITY_BACKGROUND = 1  # Housekeeping like history summaries
+PRIORITY_BULK = 2  # DM personalization for dm/mass_dm
+
+class SchedulerBusy(Exception):
+    """Raised when the inference queue is too deep to accept another request"""
+
+class InferenceScheduler:
+    """Central gate for every Ollama generation
+
+    At most `concurrency` generations run at once. Waiting requests are served
+    by priority, and round-robin between channels within a priority so one
+    busy channel can't starve the rest. Requests that can be rejected are
+    refused with SchedulerBusy once the queue (or their channel's queue) is full.
+    """
+
+    def __init__(self, concurrency: int = INFERENCE_CONCURRENCY, max_queue: int = INFERENCE_MAX_QUEUE,
+                 max_channel_queue: int = INFERENCE_MAX_CHANNEL_QUEUE):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_channel_queue = max_channel_queue
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_times: deque = deque(maxlen=500)
+        self._queues: Dict[int, OrderedDict] = defaultdict(OrderedDict)
+
+    def channel_depth(self, key) -> int:
+        """Number of requests waiting for a given channel key"""
+        return sum(len(queue.get(key, ())) for queue in self._queues.values())
+
+    async def acquire(self, key, priority: int = PRIORITY_INTERACTIVE, can_reject: bool = True):
+        """Wait for a generation slot"""
+        started = time.monotonic()
+        if self.active < self.concurrency and not self.waiting:
+            self.active += 1
+            self.wait_times.append(0.0)
+            metrics.stage("queue_wait", 0.0)
+            return
+            
+        if can_reject and (self.waiting >= self.max_queue or self.channel_depth(key) >= self.max_channel_queue):
+            self.rejected += 1
+            raise SchedulerBusy()
+            
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(key, deque()).append(waiter)
+        self.waiting += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we were cancelled; hand it on
+                self.release()
+            else:
+                self._discard(priority, key, waiter)
+            raise
+        self.wait_times.append(time.monotonic() - started)
+        metrics.stage("queue_wait", time.monotonic() - started)
+
+    def release(self):
+        """Give a generation slot back and wake the next waiter"""
+        self.active -= 1
+        self.completed += 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key, priority: int = PRIORITY_INTERACTIVE, can_reject: bool = True):
+        """Hold a generation slot for the duration of the block"""
+        await self.acquire(key, priority, can_reject)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _discard(self, priority: int, key, waiter: asyncio.Future):
+        queue = self._queues[priority].get(key)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self._queues[priority][key]
+
+    def _dispatch(self):
+        while self.active < self.concurrency and self.waiting:
+            for priority in sorted(self._queues):
+                channels = self._queues[priority]
+                if channels:
+                    break
+            else:
+                return
+            key, queue = next(iter(channels.items()))
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                channels.move_to_end(key)  # Next turn goes to another channel
+            else:
+                del channels[key]
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def stats(self) -> Dict:
+        """Snapshot of queue depth and recent wait times"""
+        waits = list(self.wait_times)
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "max_wait": max(waits) if waits else 0.0
+        }
+
+# Shared scheduler every Ollama request goes through
+inference_scheduler = InferenceScheduler()
+
+class GenerationCancelled(Exception):
+    """Raised to the caller of a tracked generation that was cancelled on purpose"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class Generation:
+    """A running, cancellable generation and what it was started for"""
+
+    def __init__(self, generation_id: int, kind: str, task: asyncio.Task, channel_id: int = None,
+                 source_message_id: int = None, description: str = "", model: str = None):
+        self.id = generation_id
+        self.kind = kind
+        self.task = task
+        self.channel_id = channel_id
+        self.source_message_id = source_message_id
+        self.description = description
+        self.model = model or MODEL_NAME
+        self.started = time.monotonic()
+        self.cancel_reason: Optional[str] = None
+
+    def cancel(self, reason: str):
+        if not self.task.done():
+            self.cancel_reason = reason
+            self.task.cancel()
+
+class GenerationTracker:
+    """Runs generations as tracked tasks with a deadline so they can be cancelled
+
+    Cancelling a generation cancels its task, which closes the HTTP request
+    to Ollama and so stops the work there too.
+    """
+
+    def __init__(self, timeout: float = GENERATION_TIMEOUT):
+        self.timeout = timeout
+        self.generations: Dict[int, Generation] = {}
+        self.cancelled = 0
+        self.timed_out = 0
+        self._next_id = 1
+
+    async def run(self, coro, kind: str, channel_id: int = None, source_message_id: int = None,
+                  description: str = "", model: str = None):
+        """Run a coroutine as a tracked generation and return its result
+
+        Raises GenerationCancelled if it was cancelled through the tracker and
+        asyncio.TimeoutError if it ran past the deadline.
+        """
+        task = asyncio.get_running_loop().create_task(asyncio.wait_for(coro, timeout=self.timeout))
+        generation = Generation(self._next_id, kind, task, channel_id, source_message_id, description, model)
+        self._next_id += 1
+        self.generations[generation.id] = generation
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if generation.cancel_reason is None:
+                raise  # Our caller was cancelled, not the generation
+            self.cancelled += 1
+            raise GenerationCancelled(generation.cancel_reason)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise
+        finally:
+            self.generations.pop(generation.id, None)
+
+    def cancel(self, generation_id: int, reason: str = "cancelled by an admin") -> bool:
+        generation = self.generations.get(generation_id)
+        if generation is None:
+            return False
+        generation.cancel(reason)
+        return True
+
+    def cancel_where(self, reason: str, kinds: tuple = None, channel_id: int = None,
+                     source_message_id: int = None) -> int:
+        """Cancel every generation matching the filters, returning how many"""
+        count = 0
+        for generation in list(self.generations.values()):
+            if kinds is not None and generation.kind not in kinds:
+                continue
+            if channel_id is not None and generation.channel_id != channel_id:
+                continue
+            if source_message_id is not None and generation.source_message_id != source_message_id:
+                continue
+            generation.cancel(reason)
+            count += 1
+        return count
+
+# Every user-facing generation runs through the tracker
+generation_tracker = GenerationTracker()
+
+# Generations tied to a conversation rather than a bulk job
+INTERACTIVE_KINDS = ("chat", "trigger", "summary")
+
+# How many requests went to each model, by request kind ((kind, model) -> count)
+routing_counts: Dict[tuple, int] = defaultdict(int)
+
+def is_light_request(kind: str, text: str = "") -> bool:
+    """Whether a request is cheap enough for the light model
+
+    Triggers, DM personalization and summaries (ROUTING_LIGHT_KINDS) always
+    are. Chat is unless it looks like a real question: long, containing
+    code, or a question of some length. When the inference queue is deep,
+    all chat goes light so the queue drains faster.
     """
-    payload = {
-        "model": MODEL_NAME,
+    if kind in ROUTING_LIGHT_KINDS:
+        return True
+    if kind != "chat":
+        return False
+    if ROUTING_QUEUE_DEPTH and inference_scheduler.waiting >= ROUTING_QUEUE_DEPTH:
+        return True
+    text = text.strip()
+    if "```" in text or len(text) >= ROUTING_HEAVY_MIN_LENGTH:
+        return False
+    return not ("?" in text and len(text.split()) >= ROUTING_QUESTION_MIN_WORDS)
+
+def guild_models(guild_id: Optional[int]) -> tuple:
+    """The (main, light) models for a guild, after its ?routing overrides"""
+    settings = (guild_settings.get(guild_id) or {}) if guild_id else {}
+    light = settings.get("light_model", OLLAMA_LIGHT_MODEL) if settings.get("routing", "on") == "on" else ""
+    return settings.get("model", MODEL_NAME), light
+
+def route_model(kind: str, guild_id: Optional[int] = None, text: str = "") -> str:
+    """Pick the model for a request of the given kind (trigger, chat, dm or summary)"""
+    model, light = guild_models(guild_id)
+    if light and is_light_request(kind, text):
+        model = light
+    routing_counts[(kind, model)] += 1
+    metrics.inc("kempai_routed_requests_total", kind=kind, model=model)
+    return model
+
+def build_generate_payload(prompt: str, stream: bool, model: str = None) -> Dict:
+    """Build an /api/generate request for a one-off prompt"""
+    return {
+        "model": model or MODEL_NAME,
         "prompt": prompt + "\nRespond directly without any <think> tags or internal monologue.",
-        "stream": False
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE
     }
-    
+
+def build_chat_payload(messages: List[Dict[str, str]], stream: bool, model: str = None) -> Dict:
+    """Build an /api/chat request from structured chat messages"""
+    return {
+        "model": model or MODEL_NAME,
+        "messages": messages,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE
+    }
+
+def format_recalled_turns(recalled: List[Dict[str, str]]) -> str:
+    """Render recalled past turns as a block of context for the prompt"""
+    lines = "\n".join(f"- {turn['role']}: {turn['content']}" for turn in recalled)
+    return f"Earlier messages that may be relevant:\n{lines}"
+
+def build_chat_messages(history: List[Dict[str, str]], summary: str = "", user_context: str = "",
+                        recalled: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+    """Turn channel history into chat messages that start with the fixed system prompt
+
+    Everything that changes between turns comes after the system prompt, so
+    consecutive requests share a prefix Ollama can reuse from its KV cache.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of earlier conversation: {summary}"})
+    if recalled:
+        messages.append({"role": "system", "content": format_recalled_turns(recalled)})
+    messages.extend({"role": turn["role"], "content": turn["content"]} for turn in history)
+    if user_context and messages[-1]["role"] == "user":
+        messages[-1] = {"role": "user", "content": f"({user_context.strip(', ')}) {messages[-1]['content']}"}
+    return messages
+
+def extract_response_text(data: Dict) -> Optional[str]:
+    """Pull the generated text out of a /api/generate or /api/chat response"""
+    if "message" in data:
+        return (data.get("message") or {}).get("content")
+    return data.get("response")
+
+async def request_ollama(path: str, payload: Dict, channel_key=None,
+                         priority: int = PRIORITY_INTERACTIVE) -> str:
+    """Send a non-streaming request to Ollama and return the cleaned response
+
+    Raises SchedulerBusy if the inference queue can't take the request.
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(OLLAMA_API_URL, json=payload) as response:
-                if response.status != 200:
-                    return f"Error: Received status code {response.status}"
-                
-                data = await response.json()
-                raw_response = data.get('response', 'Error: No response received')
-                return clean_response(raw_response)
+        async with inference_scheduler.slot(channel_key, priority, can_reject=priority < PRIORITY_BULK):
+            with metrics.timed("ollama_total"):
+                data = await inference_client.post_json(path, payload)
+        metrics.record_ollama_stats(data)
+        metrics.inc("kempai_ollama_requests_total", outcome="ok")
+        
+        raw_response = extract_response_text(data) or 'Error: No response received'
+        return clean_response(raw_response)
                 
+    except OllamaStatusError as e:
+        metrics.inc("kempai_ollama_requests_total", outcome="error")
+        return f"Error: Received status code {e.status}"
     except aiohttp.ClientError as e:
+        # Only inference workers report failures this way; the pool turns them into NoBackendAvailable
+        metrics.inc("kempai_ollama_requests_total", outcome="error")
         return f"Error connecting to Ollama: {str(e)}"
+    except NoBackendAvailable as e:
+        metrics.inc("kempai_ollama_requests_total", outcome="unavailable")
+        print(f"No Ollama backend available: {str(e)}")
+        return FRIENDLY_ERRORS["ollama_down"]
 
-@bot.event
-async def on_ready():
-    """Event handler for when the bot successfully connects to Discord"""
-    print(f"{BOT_NAME} ({bot.user}) has connected to Discord!")
-    print(f"Using model: {MODEL_NAME}")
-    
-    # Start the scheduled message checker
-    check_scheduled_messages.start()
+class StreamError(str):
+    """An error notice from a streamed request, yielded after any text that already arrived"""
+
+async def stream_ollama(path: str, payload: Dict, channel_key=None, priority: int = PRIORITY_INTERACTIVE):
+    """Send a streaming request to Ollama, yielding visible text as it is generated
+
+    A failure is yielded last as a StreamError rather than more text, so it
+    never gets mixed into a partial reply. Raises SchedulerBusy before
+    yielding anything if the inference queue is full.
+    """
+    think_filter = ThinkFilter()
     
-    # Set initial status with gaming references
-    status_options = [
-        "chillin' with the crew 🎮",
-        "maintaining server peace ✨",
-        "ready player one! 🕹️",
-        "keeping the server balanced ⚔️",
-        "vibing with the community 🎵"
-    ]
+    try:
+        async with inference_scheduler.slot(channel_key, priority, can_reject=priority < PRIORITY_BULK):
+            stream = inference_client.stream_json(path, payload)
+            started = time.perf_counter()
+            first_token = True
+            try:
+                async for data in stream:
+                    if first_token:
+                        metrics.stage("ollama_first_token", time.perf_counter() - started)
+                        first_token = False
+                    if data.get('done'):
+                        metrics.stage("ollama_total", time.perf_counter() - started)
+                        metrics.record_ollama_stats(data)
+                        metrics.inc("kempai_ollama_requests_total", outcome="ok")
+                    text = think_filter.feed(extract_response_text(data) or '')
+                    if text:
+                        yield text
+                    if data.get('done'):
+                        break
+            finally:
+                # Closing the stream closes the HTTP response, even if we stop early
+                await stream.aclose()
+        text = think_filter.flush()
+        if text:
+            yield text
+            
+    except asyncio.TimeoutError:
+        metrics.inc("kempai_ollama_requests_total", outcome="error")
+        yield StreamError("Error: Ollama took too long to respond")
+    except OllamaStatusError as e:
+        metrics.inc("kempai_ollama_requests_total", outcome="error")
+        yield StreamError(f"Error: Received status code {e.status}")
+    except aiohttp.ClientError as e:
+        # The host dropped mid-reply, after part of it was already posted
+        metrics.inc("kempai_ollama_requests_total", outcome="error")
+        yield StreamError(f"Error: lost connection to Ollama ({str(e)})")
+    except NoBackendAvailable as e:
+        metrics.inc("kempai_ollama_requests_total", outcome="unavailable")
+        print(f"No Ollama backend available: {str(e)}")
+        yield StreamError(FRIENDLY_ERRORS["ollama_down"])
+
+async def get_ollama_response(prompt: str, channel_key=None, priority: int = PRIORITY_INTERACTIVE,
+                              use_cache: bool = False, model: str = None) -> str:
+    """
+    Send a prompt to Ollama API and get the response
+    """
+    model = model or MODEL_NAME
+    use_cache = use_cache and response_cache.enabled
+    if use_cache:
+        cached = response_cache.get(model, prompt)
+        if cached is not None:
+            return cached
     
-    activity = discord.Game(name=random.choice(status_options))
-    await bot.change_presence(activity=activity)
+    async def generate() -> str:
+        response = await request_ollama('/api/generate', build_generate_payload(prompt, False, model),
+                                        channel_key, priority)
+        if use_cache and is_cacheable_response(response):
+            response_cache.put(model, prompt, response)
+        return response
     
-    # Log startup to log channel if configured
-    if LOGS_CHANNEL_ID:
-        for guild in bot.guilds:
-            log_channel = guild.get_channel(LOGS_CHANNEL_ID)
-            if log_channel:
-                startup_messages = [
-                    f"🎮 **{BOT_NAME} has spawned in!** Ready to game and moderate!",
-                    f"🚀 **Server co-pilot {BOT_NAME} online!** Let's keep this server awesome!",
-                    f"⚔️ **{BOT_NAME} has joined the party!** Ready to help and hang out!"
-                ]
-                await log_channel.send(random.choice(startup_messages))
+    # Priority is part of the key so chat never ends up waiting behind a bulk DM request
+    return await single_flight.run((model, priority, ResponseCache.normalize(prompt)), generate)
 
-@bot.event
-async def on_message(message):
-    if message.author.bot:
-        return
-        
-    # Log the message
-    if isinstance(message.channel, discord.DMChannel):
-        # Log DM received
-        for guild in bot.guilds:
-            await log_action(
-                guild,
-                "dm",
-                "DM Received",
-                str(message.author),
-                "Direct Message",
-                f"Content: {message.content[:100]}..." if len(message.content) > 100 else message.content
-            )
-    else:
-        # Log regular chat message
-        await log_action(
-            message.guild,
-            "chat",
-            "Message Sent",
-            str(message.author),
-            f"#{message.channel.name}",
-            f"Content: {message.content[:100]}..." if len(message.content) > 100 else message.content
-        )
-    
-    # Process commands first
-    await bot.process_commands(message)
+async def get_ollama_chat_response(messages: List[Dict[str, str]], channel_key=None,
+                                   priority: int = PRIORITY_INTERACTIVE, model: str = None) -> str:
+    """
+    Send chat messages to Ollama's chat API and get the response
+    """
+    return await request_ollama('/api/chat', build_chat_payload(messages, False, model), channel_key, priority)
+
+def stream_ollama_response(prompt: str, channel_key=None, priority: int = PRIORITY_INTERACTIVE, model: str = None):
+    """Stream the response to a prompt from Ollama's generate API"""
+    return stream_ollama('/api/generate', build_generate_payload(prompt, True, model), channel_key, priority)
+
+def stream_ollama_chat_response(messages: List[Dict[str, str]], channel_key=None,
+                                priority: int = PRIORITY_INTERACTIVE, model: str = None):
+    """Stream the response to chat messages from Ollama's chat API"""
+    return stream_ollama('/api/chat', build_chat_payload(messages, True, model), channel_key, priority)
+
+# Where a member's name goes in a shared message, plus the variants models tend to write instead
+NAME_PLACEHOLDER = "{name}"
+NAME_PLACEHOLDER_PATTERN = re.compile(r"[{\[<]\s*name\s*[}\]>]", re.IGNORECASE)
+# The start of a placeholder at the end of streamed text, held back until the rest arrives
+PARTIAL_PLACEHOLDER_PATTERN = re.compile(r"[{\[<]\s*(n(a(me?)?)?)?\s*$", re.IGNORECASE)
+
+def fill_name(text: str, name: Optional[str]) -> str:
+    """Put a member's name wherever a shared response has the placeholder"""
+    if name is None:
+        return text
+    return NAME_PLACEHOLDER_PATTERN.sub(lambda _: name, text)
+
+class StreamingReply:
+    """Progressively edits a Discord reply as streamed text arrives
+
+    With a name, the text is a shared response whose placeholders are
+    filled in with that name on the way out.
+    """
+
+    def __init__(self, source: discord.Message, edit_interval: float = STREAM_EDIT_INTERVAL, name: str = None):
+        self.source = source
+        self.edit_interval = edit_interval
+        self.name = name
+        self.text = ""
+        self._messages: List[discord.Message] = []
+        self._shown = ""
+        self._last_edit = 0.0
+
+    def _pages(self, final: bool = False) -> List[str]:
+        text = self.text.rstrip()
+        if self.name is not None:
+            if not final:
+                text = PARTIAL_PLACEHOLDER_PATTERN.sub("", text)
+            text = fill_name(text, self.name)
+        return [text[i:i + DISCORD_MESSAGE_LIMIT] for i in range(0, len(text), DISCORD_MESSAGE_LIMIT)]
+
+    async def push(self, chunk: str):
+        """Append streamed text, posting or editing the reply if it's time to"""
+        self.text += chunk
+        if not self.text.strip():
+            return
+        # The first visible tokens go out straight away, later ones are throttled
+        now = asyncio.get_running_loop().time()
+        if self._messages and now - self._last_edit < self.edit_interval:
+            return
+        await self._render()
+        self._last_edit = now
+
+    async def finish(self) -> str:
+        """Render the final text and return the complete response (placeholders unfilled)"""
+        self.text = self.text.strip()
+        if not self.text:
+            self.text = "Error: No response received"
+        await self._render(final=True)
+        return self.text
+
+    async def discard(self):
+        """Delete whatever was already posted (used when the generation is cancelled)"""
+        for sent in self._messages:
+            try:
+                await sent.delete()
+            except discord.HTTPException:
+                pass
+        self._messages = []
+
+    async def _render(self, final: bool = False):
+        pages = self._pages(final)
+        for index, page in enumerate(pages):
+            if index < len(self._messages):
+                # Only the last already-sent page can still be growing
+                if index == len(self._messages) - 1 and page != self._shown:
+                    with metrics.timed("discord_reply"):
+                        await self._messages[index].edit(content=page)
+                    self._shown = page
+            else:
+                with metrics.timed("discord_reply"):
+                    if index == 0:
+                        sent = await self.source.reply(page)
+                    else:
+                        sent = await self.source.channel.send(page)
+                self._messages.append(sent)
+                self._shown = page
+
+async def send_ollama_reply(message: discord.Message, prompt: str = None,
+                            messages: List[Dict[str, str]] = None, use_cache: bool = False,
+                            model: str = None, flight_key: tuple = None, name: str = None) -> str:
+    """Reply to a message with Ollama's response, streaming it if enabled
+
+    Pass either a plain prompt (generate API) or chat messages (chat API).
+    Prompt replies can be served from and stored in the response cache.
+    Replies given the same flight_key while one is being generated share
+    it: the first streams as usual and the rest post its final text.
+    With a name, the prompt asks for NAME_PLACEHOLDER instead of the
+    user's name, so cached and shared responses are the same for every
+    user, and each reply fills in its own name.
+    If the inference queue is full the user gets a friendly "busy" reply.
+    """
+    channel_key = message.channel.id
+    use_cache = use_cache and response_cache.enabled and messages is None
+    model = model or MODEL_NAME
+    if use_cache:
+        cached = response_cache.get(model, prompt)
+        if cached is not None:
+            cached = fill_name(cached, name)
+            with metrics.timed("discord_reply"):
+                await message.reply(cached)
+            return cached
+            
+    replied = False
     
-    # Skip further processing if it's a command
-    if message.content.startswith('?'):
-        return
+    async def generate() -> str:
+        nonlocal replied
+        replied = True  # Only runs for the caller whose reply carries the generation
+        if not STREAM_RESPONSES:
+            if messages is not None:
+                response = await get_ollama_chat_response(messages, channel_key, model=model)
+            else:
+                response = await get_ollama_response(prompt, channel_key, model=model)
+            with metrics.timed("discord_reply"):
+                await message.reply(fill_name(response, name))
+        else:
+            reply = StreamingReply(message, name=name)
+            if messages is not None:
+                chunks = stream_ollama_chat_response(messages, channel_key, model=model)
+            else:
+                chunks = stream_ollama_response(prompt, channel_key, model=model)
+            error = None
+            try:
+                async for chunk in chunks:
+                    if isinstance(chunk, StreamError):
+                        error = chunk
+                        break
+                    await reply.push(chunk)
+            except asyncio.CancelledError:
+                await reply.discard()
+                raise
+            finally:
+                # Close the stream right away so the Ollama request and queue slot are released
+                await chunks.aclose()
+            if error is None:
+                response = await reply.finish()
+            else:
+                # Keep whatever arrived as it is and report the failure separately;
+                # the whole response counts as an error so it's never stored or cached
+                if reply.text.strip():
+                    await reply.finish()
+                with metrics.timed("discord_reply"):
+                    await message.reply(str(error))
+                response = str(error)
+            
+        if use_cache and is_cacheable_response(response):
+            response_cache.put(model, prompt, response)
+        return response
         
-    # Check for smart response triggers
-    lower_content = message.content.lower()
-    for trigger, template in custom_triggers.items():
-        if trigger in lower_content:
-            # Generate a contextual response using the template
-            prompt = f"""
-            Generate a response based on this template: {template}
-            User's message: {message.content}
-            User's name: {message.author.name}
-            Make it sound natural and contextual.
+    try:
+        if flight_key is None:
+            return fill_name(await generate(), name)
+        response = fill_name(await single_flight.run(("reply", model) + flight_key, generate), name)
+        if not replied:
+            with metrics.timed("discord_reply"):
+                await message.reply(response)
+        return response
+    except SchedulerBusy:
+        await message.reply(FRIENDLY_ERRORS["busy"])
+        return FRIENDLY_ERRORS["busy"]
+
+class GroupPersonalizer:
+    """Personalizes one message for many members with a generation per group
+
+    Members with the same roles (and, with the presence intent, the same
+    status and activity) would get the same prompt apart from their name,
+    so the model writes one version per group with a {name} placeholder
+    and each member's name is filled in locally. Workers asking for the
+    same group wait for the first one's generation instead of repeating it.
+    """
+
+    def __init__(self, guild_id: int, message: str, kind: str, description: str, channel_id: int = None,
+                 source_message_id: int = None, presence: bool = False, by_group: bool = PERSONALIZE_BY_GROUP):
+        self.guild_id = guild_id
+        self.message = message
+        self.kind = kind
+        self.description = description
+        self.channel_id = channel_id
+        self.source_message_id = source_message_id
+        self.presence = presence
+        self.by_group = by_group
+        self.templates: Dict[tuple, str] = {}
+        self.generated = 0
+        self.personalized = 0
+        self._locks: Dict[tuple, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    @property
+    def saved(self) -> int:
+        return self.personalized - len(self.templates)
+
+    def signature(self, member: discord.Member) -> tuple:
+        """What the prompt for a member depends on, besides their name"""
+        if not self.by_group:
+            return (member.id,)
+        key = tuple(sorted(role.id for role in member.roles))
+        if self.presence:
+            key += (str(member.status), str(member.activity))
+        return key
+
+    def prompt(self, member: discord.Member) -> str:
+        # Status and activity only exist with the presence intent; Discord has no API to fetch them
+        presence = (f"Their status: {member.status}\n            Their activity: {member.activity}\n"
+                    if self.presence else "")
+        if self.by_group:
+            recipient = "a member"
+            name_rule = (f"The same text goes to everyone with these roles, so write {NAME_PLACEHOLDER} "
+                         f"wherever their name goes.\n            ")
+        else:
+            recipient = member.name
+            name_rule = ""
+        return f"""
+            Personalize this message for {recipient} based on their roles{' and status' if presence else ''}:
+            Original message: {self.message}
+            Their roles: {', '.join(role.name for role in member.roles)}
+            {presence}{name_rule}Make it sound natural and friendly, keeping the core message intact.
             """
-            
-            response = await get_ollama_response(prompt)
-            await message.reply(response)
+
+    async def personalize(self, member: discord.Member) -> str:
+        """The message for one member, generating their group's version if needed
+
+        Error responses are returned as they are and not reused, so the
+        group's next member tries again. Raises GenerationCancelled or
+        asyncio.TimeoutError like any tracked generation.
+        """
+        key = self.signature(member)
+        async with self._locks[key]:
+            template = self.templates.get(key)
+            if template is None:
+                model = route_model("dm", self.guild_id)
+                self.generated += 1
+                metrics.inc("kempai_personalization_generations_total")
+                template = await generation_tracker.run(
+                    get_ollama_response(self.prompt(member), f"dm:{self.guild_id}", PRIORITY_BULK, model=model),
+                    self.kind, self.channel_id, self.source_message_id,
+                    f"{self.description} for {'members like ' if self.by_group else ''}{member.name}", model
+                )
+                if is_error_response(template):
+                    return template
+                self.templates[key] = template
+            else:
+                metrics.inc("kempai_personalization_saved_total")
+        self.personalized += 1
+        return fill_name(template, member.name)
+
+    def summary(self) -> str:
+        return (f"{self.generated} generation{'s' if self.generated != 1 else ''} for "
+                f"{self.personalized} member{'s' if self.personalized != 1 else ''} ({self.saved} saved)")
+
+class DMCampaign:
+    """A mass DM run whose per-recipient progress is saved to disk
+
+    The campaign settings live in <id>.json and every delivered or failed DM
+    is appended to <id>.progress, so a restarted bot can pick up exactly
+    where it left off without re-sending anything.
+    """
+
+    def __init__(self, campaign_id: str, guild_id: int, channel_id: int, author_id: int,
+                 role_name: str, message: str, recipients: List[int], status_message_id: int = None,
+                 state: str = "running"):
+        self.id = campaign_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.role_name = role_name
+        self.message = message
+        self.recipients = recipients
+        self.status_message_id = status_message_id
+        self.state = state  # running, paused, cancelled or complete
+        self.results: Dict[int, str] = {}  # member id -> "sent" or "failed"
+        self.started = time.monotonic()
+        self.sent_this_run = 0
+        self.personalizer: Optional[GroupPersonalizer] = None  # Set while the campaign runs
+
+    @property
+    def sent(self) -> int:
+        return sum(1 for result in self.results.values() if result == "sent")
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for result in self.results.values() if result == "failed")
+
+    @property
+    def pending(self) -> List[int]:
+        return [member_id for member_id in self.recipients if member_id not in self.results]
+
+    def _path(self, suffix: str) -> str:
+        return os.path.join(CAMPAIGN_DIR, f"{self.id}.{suffix}")
+
+    def save(self):
+        """Write the campaign settings and state (atomically)"""
+        os.makedirs(CAMPAIGN_DIR, exist_ok=True)
+        data = {
+            "id": self.id,
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "author_id": self.author_id,
+            "role_name": self.role_name,
+            "message": self.message,
+            "recipients": self.recipients,
+            "status_message_id": self.status_message_id,
+            "state": self.state
+        }
+        temp_path = self._path("json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self._path("json"))
+
+    def record(self, member_id: int, result: str):
+        """Remember a recipient's outcome and append it to the progress log"""
+        self.results[member_id] = result
+        if result == "sent":
+            self.sent_this_run += 1
+        os.makedirs(CAMPAIGN_DIR, exist_ok=True)
+        with open(self._path("progress"), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"member_id": member_id, "result": result}) + "\n")
+
+    @classmethod
+    def load(cls, path: str) -> "DMCampaign":
+        """Rebuild a campaign and its progress from disk"""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        campaign = cls(data["id"], data["guild_id"], data["channel_id"], data["author_id"],
+                       data["role_name"], data["message"], data["recipients"],
+                       data.get("status_message_id"), data.get("state", "running"))
+        progress_path = campaign._path("progress")
+        if os.path.exists(progress_path):
+            with open(progress_path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        campaign.results[entry["member_id"]] = entry["result"]
+        return campaign
+
+    def status_text(self) -> str:
+        """Progress summary shown in the campaign's status message"""
+        done = len(self.results)
+        total = len(self.recipients)
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = self.sent_this_run / elapsed * 60
+        remaining = total - done
+        if self.state == "complete":
+            header = "DM campaign complete! ✅"
+        elif self.state == "cancelled":
+            header = "DM campaign cancelled 🛑"
+        elif self.state == "paused":
+            header = "DM campaign paused ⏸️"
+        else:
+            header = f"Sending DMs to members with {self.role_name}... 🚀"
+        text = (f"{header}\nCampaign `{self.id}` • {done}/{total} done\n"
+                f"Successful: {self.sent}\nFailed: {self.failed}")
+        if self.state == "running" and rate > 0:
+            eta = datetime.timedelta(seconds=int(remaining / rate * 60))
+            text += f"\nSpeed: {rate:.1f} DMs/min • ETA: {eta}"
+        if self.personalizer and self.personalizer.generated:
+            text += f"\nPersonalized with {self.personalizer.summary()}"
+        return text
+
+class CampaignManager:
+    """Runs DM campaigns: parallel generation feeding one rate-limited sender"""
+
+    def __init__(self, workers: int = CAMPAIGN_WORKERS, send_interval: float = CAMPAIGN_SEND_INTERVAL,
+                 status_interval: float = CAMPAIGN_STATUS_INTERVAL, max_retries: int = CAMPAIGN_MAX_RETRIES):
+        self.workers = workers
+        self.send_interval = send_interval
+        self.status_interval = status_interval
+        self.max_retries = max_retries
+        self.campaigns: Dict[str, DMCampaign] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._unpaused: Dict[str, asyncio.Event] = {}
+        self._waiting: Dict[int, List[DMCampaign]] = {}  # guild id -> campaigns waiting for it
+
+    def create(self, guild: discord.Guild, channel, author, role: discord.Role, message: str,
+               members: List[discord.Member]) -> DMCampaign:
+        """Create and save a new campaign"""
+        campaign = DMCampaign(uuid.uuid4().hex[:8], guild.id, channel.id, author.id, role.name,
+                              message, [member.id for member in members])
+        self.campaigns[campaign.id] = campaign
+        campaign.save()
+        return campaign
+
+    def start(self, campaign: DMCampaign):
+        """Run a campaign in the background (no-op if it's already running)"""
+        task = self._tasks.get(campaign.id)
+        if task and not task.done():
             return
-            
-    # Continue with regular message processing
-    channel_history = message_history.get(message.channel.id, [])
+        unpaused = self._unpaused.setdefault(campaign.id, asyncio.Event())
+        if campaign.state == "running":
+            unpaused.set()
+        self._tasks[campaign.id] = asyncio.get_running_loop().create_task(self._run(campaign))
+
+    def resume_saved(self):
+        """Restart campaigns that were still running or paused when the bot stopped"""
+        if not os.path.isdir(CAMPAIGN_DIR):
+            return
+        for name in sorted(os.listdir(CAMPAIGN_DIR)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                campaign = DMCampaign.load(os.path.join(CAMPAIGN_DIR, name))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Couldn't load campaign {name}: {e}")
+                continue
+            if not owns_guild(campaign.guild_id):
+                continue
+            if campaign.state in ("running", "paused") and campaign.id not in self._tasks:
+                self.campaigns[campaign.id] = campaign
+                self.start(campaign)
+
+    def resume_guild(self, guild_id: int):
+        """Start campaigns that were waiting for their guild to become available"""
+        for campaign in self._waiting.pop(guild_id, []):
+            if campaign.state in ("running", "paused"):
+                self.start(campaign)
+
+    def pause(self, campaign_id: str) -> bool:
+        campaign = self.campaigns.get(campaign_id)
+        if not campaign or campaign.state != "running":
+            return False
+        campaign.state = "paused"
+        self._unpaused[campaign_id].clear()
+        campaign.save()
+        return True
+
+    def resume(self, campaign_id: str) -> bool:
+        campaign = self.campaigns.get(campaign_id)
+        if not campaign or campaign.state != "paused":
+            return False
+        campaign.state = "running"
+        campaign.save()
+        self._unpaused.setdefault(campaign_id, asyncio.Event()).set()
+        self.start(campaign)
+        return True
+
+    def cancel(self, campaign_id: str) -> bool:
+        campaign = self.campaigns.get(campaign_id)
+        if not campaign or campaign.state not in ("running", "paused"):
+            return False
+        campaign.state = "cancelled"
+        campaign.save()
+        task = self._tasks.get(campaign_id)
+        if task:
+            task.cancel()
+        return True
+
+    async def update_status(self, campaign: DMCampaign):
+        """Edit the campaign's status message with its current progress"""
+        if not campaign.status_message_id:
+            return
+        channel = bot.get_channel(campaign.channel_id)
+        if not channel:
+            return
+        try:
+            await channel.get_partial_message(campaign.status_message_id).edit(content=campaign.status_text())
+        except discord.HTTPException:
+            pass
+
+    async def _resolve_member(self, guild: discord.Guild, member_id: int) -> Optional[discord.Member]:
+        member = guild.get_member(member_id)
+        if member is None:
+            try:
+                member = await guild.fetch_member(member_id)
+            except discord.HTTPException:
+                return None
+        return member
+
+    async def _generate(self, campaign: DMCampaign, guild: discord.Guild, todo: asyncio.Queue,
+                        outbox: asyncio.Queue):
+        unpaused = self._unpaused[campaign.id]
+        while True:
+            member_id = await todo.get()
+            await unpaused.wait()
+            member = await self._resolve_member(guild, member_id)
+            if member is None:
+                await outbox.put((member_id, None, None))
+                continue
+            try:
+                personalized_msg = await campaign.personalizer.personalize(member)
+            except Exception as e:
+                personalized_msg = f"Error: {e}"
+            if is_error_response(personalized_msg):
+                # Never DM someone an error message; count them as failed instead
+                await outbox.put((member_id, None, None))
+            else:
+                await outbox.put((member_id, member, personalized_msg))
+
+    async def _deliver(self, member: discord.Member, text: str) -> bool:
+        """Send one DM, backing off and retrying on transient Discord errors"""
+        for attempt in range(self.max_retries):
+            try:
+                await member.send(text)
+                return True
+            except discord.Forbidden:
+                return False
+            except discord.HTTPException as e:
+                if e.status and e.status < 500 and e.status != 429:
+                    return False
+                retry_after = getattr(e, "retry_after", None) or 2 ** attempt
+                await asyncio.sleep(retry_after)
+        return False
+
+    async def _run(self, campaign: DMCampaign):
+        guild = bot.get_guild(campaign.guild_id)
+        if guild is None:
+            # Not available yet (still connecting, or on an outage); on_guild_available picks it up
+            print(f"Campaign {campaign.id} is waiting for guild {campaign.guild_id} to become available")
+            waiting = self._waiting.setdefault(campaign.guild_id, [])
+            if campaign not in waiting:
+                waiting.append(campaign)
+            return
+        unpaused = self._unpaused[campaign.id]
+        pending = campaign.pending
+        campaign.personalizer = GroupPersonalizer(campaign.guild_id, campaign.message, "campaign",
+                                                  f"campaign {campaign.id}")
+        todo: asyncio.Queue = asyncio.Queue()
+        for member_id in pending:
+            todo.put_nowait(member_id)
+        # A small outbox keeps generation just ahead of sending
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.get_running_loop().create_task(self._generate(campaign, guild, todo, outbox))
+                   for _ in range(min(self.workers, len(pending)))]
+        last_status = 0.0
+        try:
+            for _ in range(len(pending)):
+                member_id, member, text = await outbox.get()
+                await unpaused.wait()
+                delivered = member is not None and await self._deliver(member, text)
+                campaign.record(member_id, "sent" if delivered else "failed")
+                if delivered:
+                    remember_dm(member_id, campaign.guild_id, campaign.message)
+                    
+                now = time.monotonic()
+                if now - last_status >= self.status_interval:
+                    last_status = now
+                    await self.update_status(campaign)
+                await asyncio.sleep(self.send_interval)
+                
+            campaign.state = "complete"
+            campaign.save()
+            await log_admin_action(guild, "Mass DM", str(guild.get_member(campaign.author_id) or campaign.author_id),
+                                   f"Role: {campaign.role_name}, Recipients: {campaign.sent}")
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self.update_status(campaign)
+
+# Shared campaign runner for mass_dm
+campaign_manager = CampaignManager()
+
+@bot.event
+async def on_ready():
+    """Event handler for when the bot successfully connects to Discord"""
+    print(f"{BOT_NAME} ({bot.user}) has connected to Discord!")
+    print(f"Using model: {MODEL_NAME}" + (f" (light requests: {OLLAMA_LIGHT_MODEL})" if OLLAMA_LIGHT_MODEL else ""))
+    if bot.ready_seconds is None:
+        bot.ready_seconds = time.monotonic() - STARTED_AT
+        rss = memory_usage_mb()
+        print(f"Ready in {bot.ready_seconds:.1f}s • RSS: {f'{rss:.0f} MB' if rss is not None else 'unknown'} • "
+              f"{len(bot.guilds)} guilds • {sum(1 for _ in bot.get_all_members())} members cached • "
+              f"member cache: {MEMBER_CACHE} • presences: {'on' if bot.intents.presences else 'off'}")
     
-    # Add the new message to history
-    channel_history.append({
-        "role": "user",
-        "content": message.content
-    })
+    # Load the model now so the first reply doesn't pay for a cold start
+    if OLLAMA_WARMUP:
+        model_warmer.warm(MODEL_NAME)
+        if OLLAMA_LIGHT_MODEL:
+            model_warmer.warm(OLLAMA_LIGHT_MODEL)
     
-    # Rest of the existing on_message handler...
-    # Add personality context to the prompt
-    personality = f"""You are {BOT_NAME}, a Discord co-owner and moderator. {BOT_BACKSTORY}
+    # Pick up DM campaigns interrupted by a restart
+    campaign_manager.resume_saved()
+    
+    # Set initial status with gaming references
+    status_options = [
+        "chillin' with the crew 🎮",
+        "maintaining server peace ✨",
+        "ready player one! 🕹️",
+        "keeping the server balanced ⚔️",
+        "vibing with the community 🎵"
+    ]
+    
+    activity = discord.Game(name=random.choice(status_options))
+    await bot.change_presence(activity=activity)
+    
+    # Log startup to log channel if configured
+    if LOGS_CHANNEL_ID:
+        for guild in bot.guilds:
+            log_channel = guild.get_channel(LOGS_CHANNEL_ID)
+            if log_channel:
+                startup_messages = [
+                    f"🎮 **{BOT_NAME} has spawned in!** Ready to game and moderate!",
+                    f"🚀 **Server co-pilot {BOT_NAME} online!** Let's keep this server awesome!",
+                    f"⚔️ **{BOT_NAME} has joined the party!** Ready to help and hang out!"
+                ]
+                await log_channel.send(random.choice(startup_messages))
 
-Personality traits:
-- {BOT_PERSONALITY_TRAITS['gaming_level']}
-- {BOT_PERSONALITY_TRAITS['moderation_style']}
-- {BOT_PERSONALITY_TRAITS['humor_type']}
-- {BOT_PERSONALITY_TRAITS['energy_level']}
+class MessageDebouncer:
+    """Coalesces bursts of messages in a channel into a single reply
 
-Response Guidelines:
-- Respond directly and naturally without any thinking out loud
-- Avoid being overly formal or robotic
-- Never use <think> tags or show your thought process
+    Each message restarts the channel's window; when it expires without a
+    new message, the callback runs once for the latest message. The window
+    grows with the number of requests already waiting for Ollama, since
+    replies would be delayed by the queue anyway.
+    """
+
+    def __init__(self, callback, window_ms: int = DEBOUNCE_MS, per_queued_ms: int = DEBOUNCE_PER_QUEUED_MS,
+                 max_ms: int = DEBOUNCE_MAX_MS):
+        self.callback = callback
+        self.window_ms = window_ms
+        self.per_queued_ms = per_queued_ms
+        self.max_ms = max_ms
+        self.coalesced = 0
+        self._pending: Dict[int, asyncio.Task] = {}
+
+    def window(self) -> float:
+        """Current debounce window in seconds"""
+        if self.window_ms <= 0:
+            return 0.0
+        window_ms = self.window_ms + self.per_queued_ms * inference_scheduler.waiting
+        return min(window_ms, self.max_ms) / 1000
 
-As a co-owner, try to be helpful but not overbearing. Keep responses short and fun.
-Current conversation context: """
-      # Add user context to the prompt
+    def submit(self, key: int, message: discord.Message):
+        """Schedule a reply for the key, replacing one that hasn't started yet"""
+        previous = self._pending.pop(key, None)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.coalesced += 1
+        task = asyncio.get_running_loop().create_task(self._fire(key, message, self.window()))
+        self._pending[key] = task
+
+    async def _fire(self, key: int, message: discord.Message, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # From here on the reply can't be replaced, only followed by a new one
+        if self._pending.get(key) is asyncio.current_task():
+            del self._pending[key]
+        await self.callback(message)
+
+async def reply_to_conversation(message: discord.Message):
+    """Reply to a channel's conversation, whose latest user message is `message`"""
+    if await rate_limited(message):
+        return
+    guild_id = message.guild.id if message.guild else 0
+    # A newer reply covers everything an in-flight one would have answered
+    generation_tracker.cancel_where("superseded by a newer message", ("chat",), channel_id=message.channel.id)
+    build_started = time.perf_counter()
+    channel_history = message_history.history(message.channel.id)
+    history_summary = message_history.summary(message.channel.id)
+    try:
+        recalled = await retrieval_memory.recall(
+            guild_id, message.channel.id, message.content, {turn["content"] for turn in channel_history}
+        )
+    except Exception as e:
+        # Recalled context is a bonus; reply without it rather than not at all
+        print(f"Retrieval memory recall failed: {type(e).__name__}: {str(e)}")
+        recalled = []
+    
+    # Add user context to the prompt
     user_context = ""
     if isinstance(message.channel, discord.TextChannel):  # Check if it's a guild channel
         if message.author.guild_permissions.administrator:
             user_context = "Speaking to a fellow server admin and member, "
     
-    # Construct the prompt with context
-    messages_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in channel_history])
-    full_prompt = f"{personality}\n{user_context}{messages_text}"
+    # Construct the request: structured chat messages, or one flattened prompt
+    chat_messages = None
+    full_prompt = None
+    if OLLAMA_USE_CHAT_API:
+        chat_messages = build_chat_messages(channel_history, history_summary, user_context, recalled)
+    else:
+        messages_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in channel_history])
+        if recalled:
+            messages_text = f"{format_recalled_turns(recalled)}\n{messages_text}"
+        if history_summary:
+            messages_text = f"Summary of earlier conversation: {history_summary}\n{messages_text}"
+        full_prompt = f"{SYSTEM_PROMPT}\nCurrent conversation context: \n{user_context}{messages_text}"
+    metrics.stage("prompt_build", time.perf_counter() - build_started)
+    model = route_model("chat", message.guild.id if message.guild else None, message.content)
     
     # Show typing indicator
     async with message.channel.typing():
         try:
-            # Get response from Ollama
-            response = await get_ollama_response(full_prompt)
+            # Get response from Ollama and send it (streamed if enabled)
+            try:
+                response = await generation_tracker.run(
+                    send_ollama_reply(message, full_prompt, chat_messages, model=model),
+                    "chat", message.channel.id, message.id, f"reply to {message.author}", model
+                )
+            except GenerationCancelled:
+                return
+            except asyncio.TimeoutError:
+                await message.reply(FRIENDLY_ERRORS["timeout"])
+                return
+            metrics.stage("end_to_end", (discord.utils.utcnow() - message.created_at).total_seconds())
             
             # Add random reaction occasionally to seem more human-like
             if random.random() < 0.2:  # 20% chance
                 await message.add_reaction(random.choice(success_reactions))
             
-            # Add bot's response to history
-            channel_history.append({
-                "role": "assistant",
-                "content": response
-            })
-              # Send response
-            await message.reply(response)
+            # Add bot's response to history (failed replies aren't worth remembering)
+            if not is_error_response(response):
+                message_history.add(message.channel.id, "assistant", response, guild_id)
+                retrieval_memory.remember(guild_id, message.channel.id, "assistant", response)
             
             # Log bot's response
             if isinstance(message.channel, discord.DMChannel):
@@ -345,6 +3779,108 @@ Current conversation context: """
                     f"Error: {str(e)}"
                 )
 
+# Replies to conversations wait for the channel to go quiet
+message_debouncer = MessageDebouncer(reply_to_conversation)
+
+@bot.event
+async def on_message(message):
+    if message.author.bot:
+        return
+        
+    # Cheap gate first so ignored chatter never reaches prompt building or inference
+    with metrics.timed("gate"):
+        engagement = engagement_level(message)
+    engagement_counts[engagement] += 1
+        
+    # Log the message
+    if isinstance(message.channel, discord.DMChannel):
+        # Log DM received
+        for guild in bot.guilds:
+            await log_action(
+                guild,
+                "dm",
+                "DM Received",
+                str(message.author),
+                "Direct Message",
+                f"Content: {message.content[:100]}..." if len(message.content) > 100 else message.content
+            )
+    else:
+        # Log regular chat message
+        await log_action(
+            message.guild,
+            "chat",
+            "Message Sent",
+            str(message.author),
+            f"#{message.channel.name}",
+            f"Content: {message.content[:100]}..." if len(message.content) > 100 else message.content
+        )
+    
+    # Process commands first
+    if message.content.startswith('?'):
+        with metrics.timed("command"):
+            await bot.process_commands(message)
+    
+    # Skip further processing if it's a command or not worth engaging with
+    if message.content.startswith('?') or engagement == ENGAGE_NONE:
+        return
+        
+    guild_id = message.guild.id if message.guild else 0
+    
+    # Check for smart response triggers
+    matcher = trigger_matchers.get(guild_id)
+    with metrics.timed("trigger_match"):
+        trigger = matcher.find(message.content.lower()) if matcher else None
+    if trigger is not None:
+        template = custom_triggers[guild_id][trigger]
+        # Generate a contextual response using the template
+        prompt = f"""
+        Generate a response based on this template: {template}
+        User's message: {message.content}
+        Write {NAME_PLACEHOLDER} wherever you would use the user's name.
+        Make it sound natural and contextual.
+        """
+        
+        # Rate limit only what would actually reach Ollama
+        if await rate_limited(message):
+            return
+        model = route_model("trigger", guild_id, message.content)
+        # A raid posting the same message at once gets one generation, shared by every reply;
+        # the prompt leaves the name out, so each reply fills in its own author's
+        flight_key = (guild_id, trigger, template, ResponseCache.normalize(message.content))
+        try:
+            await generation_tracker.run(
+                send_ollama_reply(message, prompt, use_cache=trigger not in uncached_triggers[guild_id], model=model,
+                                  flight_key=flight_key, name=message.author.name),
+                "trigger", message.channel.id, message.id, f"smart response '{trigger}'", model
+            )
+            metrics.stage("end_to_end", (discord.utils.utcnow() - message.created_at).total_seconds())
+        except GenerationCancelled:
+            pass
+        except asyncio.TimeoutError:
+            await message.reply(FRIENDLY_ERRORS["timeout"])
+        return
+        
+    if engagement < ENGAGE_CHAT:
+        return
+            
+    # Continue with regular message processing
+    # Add the new message to history, then reply once the channel goes quiet
+    # (rate limits are charged per reply, so a burst that gets one reply costs one token)
+    await message_history.ensure_loaded(message.channel.id, guild_id)
+    message_history.add(message.channel.id, "user", message.content, guild_id)
+    retrieval_memory.remember(guild_id, message.channel.id, "user", message.content)
+    message_debouncer.submit(message.channel.id, message)
+
+@bot.event
+async def on_guild_available(guild):
+    """Start DM campaigns that were waiting for this guild"""
+    campaign_manager.resume_guild(guild.id)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    """Stop generating a reply to a message that was deleted"""
+    generation_tracker.cancel_where("source message deleted", source_message_id=payload.message_id)
+
 @bot.event
 async def on_member_join(member):
     """Welcome new members when they join"""
@@ -365,7 +3901,143 @@ async def setmodel(ctx, model_name: str):
     global MODEL_NAME
     old_model = MODEL_NAME
     MODEL_NAME = model_name
-    await ctx.send(f"Model changed from {old_model} to: {model_name}")
+    response_cache.invalidate(old_model)
+    generation_tracker.cancel_where("model changed", INTERACTIVE_KINDS)
+    if OLLAMA_WARMUP and model_warmer.warm(model_name):
+        await ctx.send(f"Model changed from {old_model} to: {model_name} (warming it up in the background 🔥)")
+    else:
+        await ctx.send(f"Model changed from {old_model} to: {model_name}")
+    if OLLAMA_UNLOAD_PREVIOUS and normalize_model_name(old_model) != normalize_model_name(model_name):
+        await model_warmer.unload(old_model)
+
+@bot.command()
+async def queuestatus(ctx):
+    """Show how busy the inference queue is (Admin only)"""
+    if not await permission_check(ctx):
+        return
+        
+    stats = inference_scheduler.stats()
+    await ctx.send(
+        f"🧠 **Inference queue**\n"
+        f"Running: {stats['active']}/{inference_scheduler.concurrency} • Waiting: {stats['waiting']}\n"
+        f"Avg wait: {stats['avg_wait']:.2f}s • Max wait: {stats['max_wait']:.2f}s\n"
+        f"Completed: {stats['completed']} • Turned away (busy): {stats['rejected']}\n"
+        f"Rate limited: " + ", ".join(f"{count} by {scope}" for scope, count in rate_limiter.throttled_counts().items())
+    )
+
+@bot.command()
+async def stats(ctx):
+    """Show latency percentiles for each stage of the message pipeline (Admin only)"""
+    if not await permission_check(ctx):
+        return
+
+    lines = [f"{'stage':<19}{'count':>7}{'p50':>11}{'p95':>11}{'p99':>11}"]
+    for stage in Metrics.STAGES:
+        histogram = metrics.histogram("kempai_stage_seconds", stage=stage)
+        if histogram is None:
+            continue
+        lines.append(f"{stage:<19}{histogram.count:>7}" +
+                     "".join(f"{histogram.percentile(p) * 1000:>9.1f}ms" for p in (50, 95, 99)))
+    speed = metrics.histogram("kempai_ollama_tokens_per_second")
+    if speed:
+        lines.append(f"\nGeneration speed: {speed.percentile(50):.1f} tokens/s (p50) • "
+                     f"{speed.percentile(5):.1f} tokens/s (slowest 5%)")
+    lines.append(f"Tokens generated: {metrics.counter('kempai_ollama_eval_tokens_total'):.0f} • "
+                 f"Prompt tokens: {metrics.counter('kempai_ollama_prompt_tokens_total'):.0f}")
+    await ctx.send("📊 **Pipeline stats** (recent samples)\n```\n" + "\n".join(lines) + "\n```")
+
+@bot.command()
+async def modelstatus(ctx, model_name: str = None):
+    """Show whether the current (or a given) model is loaded on each Ollama backend (Admin only)"""
+    if not await permission_check(ctx):
+        return
+
+    model_name = model_name or MODEL_NAME
+    model = normalize_model_name(model_name)
+    lines = []
+    for backend in ollama_pool.backends:
+        try:
+            status, ps = await ollama_client.get_json(backend.url('/api/ps'), OLLAMA_HEALTH_TIMEOUT)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            lines.append(f"🔴 `{backend.base_url}` • unreachable")
+            continue
+        running = {normalize_model_name(entry.get('name', '')): entry
+                   for entry in (ps or {}).get('models', [])} if status == 200 else {}
+        warm_status = model_warmer.status.get((backend.base_url, model), {})
+        if model in running:
+            entry = running[model]
+            details = f"🔥 warm • {entry.get('size_vram', 0) / 1024 ** 3:.1f} GB in VRAM"
+            if entry.get('expires_at'):
+                details += f" • unloads at {entry['expires_at'][:19].replace('T', ' ')}"
+        elif warm_status.get('state') == "warming":
+            details = "⏳ loading"
+        else:
+            details = "🧊 cold"
+        if warm_status.get('seconds') is not None:
+            details += f" • last warm-up took {warm_status['seconds']:.1f}s"
+        others = [name for name in running if name != model]
+        if others:
+            details += f" • also loaded: {', '.join(others)}"
+        lines.append(f"`{backend.base_url}` • {details}")
+    await ctx.send(f"🧠 **{model_name}** (keep-alive: {OLLAMA_KEEP_ALIVE})\n" + "\n".join(lines))
+
+@bot.command()
+async def backends(ctx):
+    """Show each Ollama backend's health and load (Admin only)"""
+    if not await permission_check(ctx):
+        return
+
+    state_emojis = {"healthy": "🟢", "degraded": "🟡", "ejected": "🔴"}
+    model = normalize_model_name(MODEL_NAME)
+    lines = []
+    for backend in ollama_pool.backends:
+        if not backend.probed:
+            model_state = "not probed yet"
+        elif model in backend.loaded:
+            model_state = f"{MODEL_NAME} loaded"
+        elif model in backend.models:
+            model_state = f"{MODEL_NAME} installed"
+        else:
+            model_state = f"no {MODEL_NAME}"
+        lines.append(f"{state_emojis[backend.state()]} `{backend.base_url}` • {model_state} • "
+                     f"in flight: {backend.outstanding} • requests: {backend.requests} • errors: {backend.errors}")
+    await ctx.send("🖥️ **Ollama backends**\n" + "\n".join(lines))
+
+@bot.command()
+async def generations(ctx):
+    """List generations that are currently running (Admin only)"""
+    if not await permission_check(ctx):
+        return
+        
+    if not generation_tracker.generations:
+        await ctx.send("Nothing generating right now 😴")
+        return
+        
+    now = time.monotonic()
+    lines = []
+    for generation in list(generation_tracker.generations.values())[:20]:
+        where = f" in <#{generation.channel_id}>" if generation.channel_id else ""
+        lines.append(f"`{generation.id}` • {generation.kind}{where} • {generation.description} • "
+                     f"{generation.model} • {now - generation.started:.0f}s")
+    await ctx.send("**Running generations:**\n" + "\n".join(lines) +
+                   f"\nCancelled: {generation_tracker.cancelled} • Timed out: {generation_tracker.timed_out}")
+
+@bot.command()
+async def killgen(ctx, generation_id: str):
+    """Cancel a running generation by ID, or 'all' (Admin only)"""
+    if not await permission_check(ctx):
+        return
+        
+    if generation_id.lower() == "all":
+        count = generation_tracker.cancel_where(f"cancelled by {ctx.author}")
+        await ctx.send(f"Cancelled {count} generations 🛑")
+    elif generation_id.isdigit() and generation_tracker.cancel(int(generation_id), f"cancelled by {ctx.author}"):
+        await ctx.send(f"Cancelled generation `{generation_id}` 🛑")
+    else:
+        await ctx.send(f"No running generation with ID `{generation_id}` 🤔")
+        return
+        
+    await log_admin_action(ctx.guild, "Cancel Generation", str(ctx.author), generation_id)
 
 @bot.command()
 async def clearhistory(ctx):
@@ -373,8 +4045,10 @@ async def clearhistory(ctx):
     if not await permission_check(ctx):
         return
         
-    if ctx.channel.id in message_history:
-        message_history[ctx.channel.id] = []
+    generation_tracker.cancel_where("history cleared", INTERACTIVE_KINDS, channel_id=ctx.channel.id)
+    if ctx.guild:
+        retrieval_memory.forget_channel(ctx.guild.id, ctx.channel.id)
+    if message_history.clear(ctx.channel.id):
         await ctx.send("Message history cleared for this channel.")
     else:
         await ctx.send("No message history found for this channel.")
@@ -385,7 +4059,7 @@ async def allowchannel(ctx):
     if not await permission_check(ctx):
         return
         
-    allowed_channels.add(ctx.channel.id)
+    set_channel_allowed(ctx.guild.id, ctx.channel.id, True)
     await ctx.send(f"Bot will now respond in channel #{ctx.channel.name}")
 
 @bot.command()
@@ -394,21 +4068,105 @@ async def disallowchannel(ctx):
     if not await permission_check(ctx):
         return
         
-    allowed_channels.discard(ctx.channel.id)
+    set_channel_allowed(ctx.guild.id, ctx.channel.id, False)
     await ctx.send(f"Bot will no longer respond in channel #{ctx.channel.name}")
 
+@bot.command()
+async def engagement(ctx, setting: str = None, value: str = None):
+    """Show or change when the bot replies in this server (Admin only)
+
+    ?engagement on|off, ?engagement mode all|mention|reply, ?engagement minlength <n>
+    """
+    if not await permission_check(ctx):
+        return
+        
+    settings = guild_settings.get(ctx.guild.id) or {}
+    if setting is None:
+        ignored = engagement_counts[ENGAGE_NONE]
+        triggers_only = engagement_counts[ENGAGE_TRIGGERS]
+        await ctx.send(
+            f"💬 **Engagement settings**\n"
+            f"AI replies: {settings.get('enabled', 'on')} • Mode: {settings.get('mode', ENGAGEMENT_MODE)} • "
+            f"Min length: {settings.get('min_length', ENGAGEMENT_MIN_LENGTH)}\n"
+            f"Messages skipped since startup: {ignored} ignored, {triggers_only} triggers only"
+        )
+        return
+        
+    setting = setting.lower()
+    if setting in ("on", "off"):
+        set_guild_setting(ctx.guild.id, "enabled", setting)
+        await ctx.send(f"AI replies are now {setting} in this server {random.choice(success_reactions)}")
+    elif setting == "mode" and value and value.lower() in ENGAGEMENT_MODES:
+        set_guild_setting(ctx.guild.id, "mode", value.lower())
+        await ctx.send(f"Engagement mode set to {value.lower()} {random.choice(success_reactions)}")
+    elif setting == "minlength" and value and value.isdigit():
+        set_guild_setting(ctx.guild.id, "min_length", value)
+        await ctx.send(f"I'll only chat about messages with at least {value} characters {random.choice(success_reactions)}")
+    else:
+        await ctx.send("Usage: `?engagement on|off`, `?engagement mode all|mention|reply`, `?engagement minlength <n>`")
+        return
+        
+    await log_admin_action(ctx.guild, "Engagement Settings", str(ctx.author), setting, value)
+
+@bot.command()
+async def routing(ctx, setting: str = None, value: str = None):
+    """Show or change which models this server's requests go to (Admin only)
+
+    ?routing on|off, ?routing model <name|default>, ?routing light <name|default>
+    """
+    if not await permission_check(ctx):
+        return
+        
+    settings = guild_settings.get(ctx.guild.id) or {}
+    if setting is None:
+        model, light = guild_models(ctx.guild.id)
+        counts = ", ".join(f"{kind} → {name}: {count}" for (kind, name), count in sorted(routing_counts.items()))
+        await ctx.send(
+            f"🔀 **Model routing**\n"
+            f"Main model: {model}{' (server override)' if 'model' in settings else ''} • "
+            f"Light model: {light or 'none, everything uses the main model'}"
+            f"{' (server override)' if light and 'light_model' in settings else ''} • "
+            f"Routing: {settings.get('routing', 'on')}\n"
+            f"Light requests: {', '.join(ROUTING_LIGHT_KINDS) or 'none'}, and chat under "
+            f"{ROUTING_HEAVY_MIN_LENGTH} characters that isn't code or a {ROUTING_QUESTION_MIN_WORDS}+ word question"
+            f"{f' (all chat once {ROUTING_QUEUE_DEPTH} requests are waiting)' if ROUTING_QUEUE_DEPTH else ''}\n"
+            f"Routed since startup (all servers): {counts or 'nothing yet'}"
+        )
+        return
+        
+    setting = setting.lower()
+    if setting in ("on", "off"):
+        set_guild_setting(ctx.guild.id, "routing", setting)
+        await ctx.send(f"Model routing is now {setting} in this server {random.choice(success_reactions)}")
+    elif setting in ("model", "light") and value:
+        key = "model" if setting == "model" else "light_model"
+        if value.lower() == "default":
+            clear_guild_setting(ctx.guild.id, key)
+            await ctx.send(f"This server's {setting} model is back to the default {random.choice(success_reactions)}")
+        else:
+            set_guild_setting(ctx.guild.id, key, value)
+            warming = OLLAMA_WARMUP and model_warmer.warm(value)
+            await ctx.send(f"This server's {setting} model is now {value}"
+                           f"{' (warming it up in the background 🔥)' if warming else ''} {random.choice(success_reactions)}")
+    else:
+        await ctx.send("Usage: `?routing on|off`, `?routing model <name|default>`, `?routing light <name|default>`")
+        return
+        
+    await log_admin_action(ctx.guild, "Model Routing", str(ctx.author), setting, value)
+
 @bot.command()
 async def listchannels(ctx):
     """List all channels where the bot is allowed to respond (Admin only)"""
     if not await permission_check(ctx):
         return
         
-    if not allowed_channels:
+    guild_channels = allowed_channels.get(ctx.guild.id)
+    if not guild_channels:
         await ctx.send("Bot is currently allowed to respond in all channels.")
         return
         
     channel_names = []
-    for channel_id in allowed_channels:
+    for channel_id in guild_channels:
         channel = bot.get_channel(channel_id)
         if channel:
             channel_names.append(f"#{channel.name}")
@@ -545,7 +4303,7 @@ async def trust(ctx, member: discord.Member):
         await ctx.send("Only server admins can add trusted users! 🚫")
         return
         
-    trusted_users.add(member.id)
+    set_trusted(ctx.guild.id, member.id, True)
     await log_admin_action(ctx.guild, "Add Trusted User", str(ctx.author), str(member))
     await ctx.send(f"Added {member.mention} to trusted users! They can now use mod commands {random.choice(success_reactions)}")
 
@@ -556,7 +4314,7 @@ async def untrust(ctx, member: discord.Member):
         await ctx.send("Only server admins can remove trusted users! 🚫")
         return
         
-    trusted_users.discard(member.id)
+    set_trusted(ctx.guild.id, member.id, False)
     await log_admin_action(ctx.guild, "Remove Trusted User", str(ctx.author), str(member))
     await ctx.send(f"Removed {member.mention} from trusted users {random.choice(success_reactions)}")
 
@@ -597,29 +4355,26 @@ async def dm(ctx, members: commands.Greedy[discord.Member], *, message: str = No
         await ctx.send("Please provide a message to send! Usage: `?dm @user1 @user2 your message here`")
         return
         
+    # Members with the same roles share one generated message, with their own name filled in
+    personalizer = GroupPersonalizer(ctx.guild.id, message, "dm", "DM", ctx.channel.id, ctx.message.id,
+                                     presence=bot.intents.presences)
     async with ctx.typing():
         for member in members:
-            # Generate a personalized version of the message for each member
-            prompt = f"""
-            Personalize this message for {member.name} based on their roles and status:
-            Original message: {message}
-            Their roles: {', '.join(role.name for role in member.roles)}
-            Their status: {member.status}
-            Their activity: {member.activity}
-            Make it sound natural and friendly, keeping the core message intact.
-            """
-            
-            personalized_msg = await get_ollama_response(prompt)
+            try:
+                personalized_msg = await personalizer.personalize(member)
+            except (GenerationCancelled, asyncio.TimeoutError):
+                await ctx.send(f"Skipped {member.mention} - generating their message was cancelled or timed out ⏹️")
+                continue
             
             try:
                 await member.send(personalized_msg)
-                dm_conversations[member.id]["last_message"] = message
+                remember_dm(member.id, ctx.guild.id, message)
                 await log_admin_action(ctx.guild, "DM Sent", str(ctx.author), str(member))
             except discord.Forbidden:
                 await ctx.send(f"Couldn't DM {member.mention} - they might have DMs disabled 😔")
                 continue
                 
-    await ctx.send(f"Sent personalized DMs to {len(members)} members! 📨")
+    await ctx.send(f"Sent personalized DMs to {len(members)} members! 📨 ({personalizer.summary()})")
 
 @bot.command()
 async def schedule_message(ctx, channel: discord.TextChannel, time: str, *, message: str):
@@ -627,30 +4382,69 @@ async def schedule_message(ctx, channel: discord.TextChannel, time: str, *, mess
     if not await permission_check(ctx):
         return
         
-    # Parse the time string
-    total_minutes = 0
-    if 'h' in time:
-        hours = int(time.split('h')[0])
-        total_minutes += hours * 60
-        time = time.split('h')[1]
-    if 'm' in time:
-        minutes = int(time.split('m')[0])
-        total_minutes += minutes
-        
+    total_minutes = parse_duration(time)
     if total_minutes <= 0:
         await ctx.send("Please provide a valid time (e.g., '1h', '30m', '2h30m')")
         return
         
     # Schedule the message
     scheduled_time = datetime.datetime.now() + datetime.timedelta(minutes=total_minutes)
-    scheduled_messages.append({
-        "channel_id": channel.id,
-        "message": message,
-        "scheduled_time": scheduled_time,
-        "author_id": ctx.author.id
-    })
+    item = message_scheduler.add(channel.id, message, scheduled_time.timestamp(), ctx.author.id, ctx.guild.id)
+    
+    await ctx.send(f"Message #{item['id']} scheduled for {scheduled_time.strftime('%Y-%m-%d %H:%M:%S')} in {channel.mention} 📅")
+
+@bot.command()
+async def schedule_recurring(ctx, channel: discord.TextChannel, interval: str, *, message: str):
+    """Schedule a message that repeats every interval. Interval format: '1h', '30m', '2h30m'"""
+    if not await permission_check(ctx):
+        return
+        
+    total_minutes = parse_duration(interval)
+    if total_minutes <= 0:
+        await ctx.send("Please provide a valid interval (e.g., '1h', '30m', '2h30m')")
+        return
+        
+    first_time = datetime.datetime.now() + datetime.timedelta(minutes=total_minutes)
+    item = message_scheduler.add(channel.id, message, first_time.timestamp(), ctx.author.id,
+                                 ctx.guild.id, interval=total_minutes * 60)
     
-    await ctx.send(f"Message scheduled for {scheduled_time.strftime('%Y-%m-%d %H:%M:%S')} in {channel.mention} 📅")
+    await ctx.send(f"Message #{item['id']} will repeat every {interval} in {channel.mention}, "
+                   f"starting {first_time.strftime('%Y-%m-%d %H:%M:%S')} 🔁")
+
+@bot.command()
+async def list_scheduled(ctx):
+    """List this server's pending scheduled messages"""
+    if not await permission_check(ctx):
+        return
+        
+    pending = message_scheduler.pending(ctx.guild.id)
+    if not pending:
+        await ctx.send("No scheduled messages! 📅")
+        return
+        
+    lines = []
+    for item in pending[:20]:
+        due = datetime.datetime.fromtimestamp(item["due"]).strftime('%Y-%m-%d %H:%M:%S')
+        repeat = f" (every {item['interval'] // 60:.0f}m)" if item["interval"] else ""
+        preview = item["message"][:50] + ("..." if len(item["message"]) > 50 else "")
+        lines.append(f"#{item['id']} • {due}{repeat} • <#{item['channel_id']}> • {preview}")
+    more = f"\n...and {len(pending) - 20} more" if len(pending) > 20 else ""
+    await ctx.send("**Scheduled Messages:**\n" + "\n".join(lines) + more)
+
+@bot.command()
+async def cancel_scheduled(ctx, item_id: int):
+    """Cancel a scheduled message by its number"""
+    if not await permission_check(ctx):
+        return
+        
+    item = message_scheduler.items.get(item_id)
+    if not item or item["guild_id"] != ctx.guild.id:
+        await ctx.send(f"No scheduled message #{item_id} found 🤔")
+        return
+        
+    message_scheduler.cancel(item_id)
+    await log_admin_action(ctx.guild, "Cancel Scheduled Message", str(ctx.author), f"#{item_id} in <#{item['channel_id']}>")
+    await ctx.send(f"Cancelled scheduled message #{item_id} {random.choice(success_reactions)}")
 
 @bot.command()
 async def mass_dm(ctx, role: discord.Role, *, message: str):
@@ -658,36 +4452,70 @@ async def mass_dm(ctx, role: discord.Role, *, message: str):
     if not await permission_check(ctx):
         return
         
-    members = [member for member in role.members if not member.bot]
+    async with ctx.typing():
+        members = [member for member in await members_with_role(ctx.guild, role) if not member.bot]
     if not members:
         await ctx.send(f"No members found with the role {role.mention} 😕")
         return
         
-    status_msg = await ctx.send(f"Sending DMs to {len(members)} members with {role.mention}... 🚀")
-    successful = 0
-    failed = 0
-    
-    async with ctx.typing():
-        for member in members:
-            prompt = f"""
-            Create a personalized version of this message for {member.name}:
-            Original message: {message}
-            Their roles: {', '.join(role.name for role in member.roles)}
-            Make it personal but keep the core message intact.
-            """
-            
-            personalized_msg = await get_ollama_response(prompt)
-            
-            try:
-                await member.send(personalized_msg)
-                dm_conversations[member.id]["last_message"] = message
-                successful += 1
-                await asyncio.sleep(1)  # Rate limiting protection
-            except discord.Forbidden:
-                failed += 1
-                
-    await status_msg.edit(content=f"DM campaign complete! ✅\nSuccessful: {successful}\nFailed: {failed}")
-    await log_admin_action(ctx.guild, "Mass DM", str(ctx.author), f"Role: {role.name}, Recipients: {successful}")
+    campaign = campaign_manager.create(ctx.guild, ctx.channel, ctx.author, role, message, members)
+    status_msg = await ctx.send(f"Sending DMs to {len(members)} members with {role.mention}... 🚀\n"
+                                f"Campaign `{campaign.id}` - use `?pause_campaign`, `?resume_campaign` "
+                                f"or `?cancel_campaign` with that ID")
+    campaign.status_message_id = status_msg.id
+    campaign.save()
+    campaign_manager.start(campaign)
+
+@bot.command()
+async def campaigns(ctx):
+    """List this server's DM campaigns (Admin only)"""
+    if not await permission_check(ctx):
+        return
+        
+    guild_campaigns = [c for c in campaign_manager.campaigns.values() if c.guild_id == ctx.guild.id]
+    if not guild_campaigns:
+        await ctx.send("No DM campaigns found! 📭")
+        return
+        
+    lines = [f"`{c.id}` • {c.role_name} • {c.state} • {len(c.results)}/{len(c.recipients)} done"
+             for c in guild_campaigns]
+    await ctx.send("**DM Campaigns:**\n" + "\n".join(lines))
+
+@bot.command()
+async def pause_campaign(ctx, campaign_id: str):
+    """Pause a running DM campaign"""
+    if not await permission_check(ctx):
+        return
+        
+    if campaign_manager.pause(campaign_id):
+        await campaign_manager.update_status(campaign_manager.campaigns[campaign_id])
+        await ctx.send(f"Paused campaign `{campaign_id}` ⏸️")
+    else:
+        await ctx.send(f"No running campaign with ID `{campaign_id}` 🤔")
+
+@bot.command()
+async def resume_campaign(ctx, campaign_id: str):
+    """Resume a paused DM campaign"""
+    if not await permission_check(ctx):
+        return
+        
+    if campaign_manager.resume(campaign_id):
+        await campaign_manager.update_status(campaign_manager.campaigns[campaign_id])
+        await ctx.send(f"Resumed campaign `{campaign_id}` ▶️")
+    else:
+        await ctx.send(f"No paused campaign with ID `{campaign_id}` 🤔")
+
+@bot.command()
+async def cancel_campaign(ctx, campaign_id: str):
+    """Cancel a DM campaign"""
+    if not await permission_check(ctx):
+        return
+        
+    if campaign_manager.cancel(campaign_id):
+        await log_admin_action(ctx.guild, "Cancel Mass DM", str(ctx.author), f"Campaign {campaign_id}")
+        await ctx.send(f"Cancelled campaign `{campaign_id}` 🛑")
+    else:
+        await ctx.send(f"No active campaign with ID `{campaign_id}` 🤔")
 
 @bot.command()
 async def set_smart_response(ctx, trigger: str, *, response_template: str):
@@ -695,49 +4523,146 @@ async def set_smart_response(ctx, trigger: str, *, response_template: str):
     if not await permission_check(ctx):
         return
         
-    custom_triggers[trigger.lower()] = response_template
+    save_smart_response(ctx.guild.id, trigger.lower(), response_template)
     await ctx.send(f"Smart response added for trigger: '{trigger}' {random.choice(success_reactions)}")
 
+@bot.command()
+async def smart_response_cache(ctx, trigger: str, setting: str):
+    """Turn response caching on or off for one smart response trigger"""
+    if not await permission_check(ctx):
+        return
+        
+    trigger = trigger.lower()
+    if trigger not in custom_triggers.get(ctx.guild.id, {}):
+        await ctx.send(f"No smart response found for trigger: '{trigger}' 🤔")
+        return
+        
+    if setting.lower() in ("off", "no", "false"):
+        set_trigger_cacheable(ctx.guild.id, trigger, False)
+        await ctx.send(f"Responses for '{trigger}' will be generated fresh every time 🎲")
+    else:
+        set_trigger_cacheable(ctx.guild.id, trigger, True)
+        await ctx.send(f"Responses for '{trigger}' can now be cached {random.choice(success_reactions)}")
+
+@bot.command()
+async def cachestats(ctx):
+    """Show response cache hits and misses (Admin only)"""
+    if not await permission_check(ctx):
+        return
+        
+    lookups = response_cache.hits + response_cache.misses
+    hit_rate = response_cache.hits / lookups * 100 if lookups else 0.0
+    state = "on" if response_cache.enabled else "off"
+    await ctx.send(
+        f"🗃️ **Response cache** ({state})\n"
+        f"Entries: {len(response_cache)}/{response_cache.max_size} • TTL: {response_cache.ttl:.0f}s\n"
+        f"Hits: {response_cache.hits} • Misses: {response_cache.misses} • Hit rate: {hit_rate:.1f}%\n"
+        f"Identical requests in flight: {single_flight.shared} shared a generation • "
+        f"{single_flight.started} generated • {len(single_flight)} running\n"
+        f"DM personalization: {metrics.counter('kempai_personalization_saved_total'):.0f} generations saved by "
+        f"sharing one per role group • {metrics.counter('kempai_personalization_generations_total'):.0f} generated"
+    )
+
 @bot.command()
 async def list_smart_responses(ctx):
     """List all configured smart responses"""
     if not await permission_check(ctx):
         return
         
-    if not custom_triggers:
+    guild_triggers = custom_triggers.get(ctx.guild.id)
+    if not guild_triggers:
         await ctx.send("No smart responses configured yet! 📝")
         return
         
     response = "**Configured Smart Responses:**\n\n"
-    for trigger, template in custom_triggers.items():
-        response += f"📌 Trigger: '{trigger}'\n💬 Response: {template}\n\n"
+    for trigger, template in guild_triggers.items():
+        cache_note = " (always fresh)" if trigger in uncached_triggers[ctx.guild.id] else ""
+        response += f"📌 Trigger: '{trigger}'{cache_note}\n💬 Response: {template}\n\n"
         
     await ctx.send(response)
 
-@tasks.loop(minutes=1)
-async def check_scheduled_messages():
-    """Check and send scheduled messages"""
-    current_time = datetime.datetime.now()
-    messages_to_remove = []
+async def run_inference_worker(path: str):
+    """Run this process as an inference worker until it's stopped"""
+    await ollama_client.start()
+    ollama_pool.start()
+    try:
+        await InferenceWorker(path, ollama_pool).serve_forever()
+    finally:
+        await ollama_pool.close()
+        await ollama_client.close()
+
+def launch(gateways: int, workers: int, shard_count: int, socket_dir: str):
+    """Run inference workers and sharded gateway processes, restarting any that exit"""
+    sockets = [os.path.join(socket_dir, f"kempai-inference-{i}.sock") for i in range(workers)]
+    processes = {}
+    for i, path in enumerate(sockets):
+        command = [sys.executable, os.path.abspath(__file__), "worker", "--socket", path]
+        processes[f"inference worker {i}"] = (command, {})
+    for i in range(gateways):
+        shard_ids = [shard for shard in range(shard_count) if shard % gateways == i]
+        env = {
+            "BOT_SHARDING": "true",
+            "SHARD_COUNT": str(shard_count),
+            "SHARD_IDS": ",".join(map(str, shard_ids)),
+            "INFERENCE_WORKER_SOCKETS": ",".join(sockets)
+        }
+        processes[f"gateway {i} (shards {env['SHARD_IDS']})"] = ([sys.executable, os.path.abspath(__file__)], env)
     
-    for scheduled_msg in scheduled_messages:
-        if current_time >= scheduled_msg["scheduled_time"]:
-            channel = bot.get_channel(scheduled_msg["channel_id"])
-            if channel:
-                try:
-                    await channel.send(scheduled_msg["message"])
-                except discord.Forbidden:
-                    print(f"Failed to send scheduled message in channel {channel.id}")
-            messages_to_remove.append(scheduled_msg)
-            
-    for msg in messages_to_remove:
-        scheduled_messages.remove(msg)
+    running = {}
+    restart_at = {name: 0.0 for name in processes}
+    try:
+        while True:
+            for name, (command, env) in processes.items():
+                process = running.get(name)
+                if process is not None and process.poll() is None:
+                    continue
+                if process is not None:
+                    print(f"{name} exited with code {process.returncode}; restarting in 5s")
+                    running.pop(name)
+                    restart_at[name] = time.monotonic() + 5
+                if time.monotonic() >= restart_at[name]:
+                    print(f"Starting {name}")
+                    running[name] = subprocess.Popen(command, env={**os.environ, **env})
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in running.values():
+            process.terminate()
+        for process in running.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
 
 def main():
     """Main entry point of the bot"""
+    parser = argparse.ArgumentParser(description=f"{BOT_NAME} Discord bot")
+    subcommands = parser.add_subparsers(dest="command")
+    worker_parser = subcommands.add_parser("worker", help="Serve Ollama requests for gateway processes")
+    worker_parser.add_argument("--socket", default=os.path.join(tempfile.gettempdir(), "kempai-inference-0.sock"),
+                               help="Unix socket to listen on")
+    launch_parser = subcommands.add_parser("launch", help="Run sharded gateway processes plus inference workers")
+    launch_parser.add_argument("--gateways", type=int, default=2, help="Gateway processes to split the shards across")
+    launch_parser.add_argument("--workers", type=int, default=2, help="Inference worker processes")
+    launch_parser.add_argument("--shards", type=int, default=None, help="Total shards (default: one per gateway)")
+    launch_parser.add_argument("--socket-dir", default=tempfile.gettempdir(), help="Where worker sockets go")
+    args = parser.parse_args()
+    
+    if args.command == "worker":
+        asyncio.run(run_inference_worker(args.socket))
+        return
+        
     if not DISCORD_TOKEN:
         raise ValueError("Discord token not found in .env file")
     
+    if args.command == "launch":
+        shard_count = args.shards or args.gateways
+        if shard_count < args.gateways:
+            raise ValueError("Need at least one shard per gateway process")
+        launch(args.gateways, args.workers, shard_count, args.socket_dir)
+        return
+    
     bot.run(DISCORD_TOKEN)
 
 if __name__ == "__main__":